@@ -0,0 +1,393 @@
+# Bitsliced AES over many blocks at once, using Python big integers as bit-planes.
+#
+# A batch of N blocks is transposed into 128 planes: plane (j, b) is an N-bit integer
+# holding bit b of state byte j for every block. A round is then a fixed sequence of
+# big-int XOR/AND operations regardless of N: SubBytes is the Boyar-Peralta Boolean
+# circuit, ShiftRows only reorders planes and MixColumns is XORs between planes.
+# Nothing indexes a table with data or key bits and nothing branches on them: round
+# keys are XORed in as precomputed all-zero / all-ones planes and the transposition
+# in and out of planes is shift-and-mask on big integers. (CPython's big-int
+# arithmetic itself makes no constant time promise.)
+
+import struct
+
+import counter_mode
+
+# Blocks per batch, must be a multiple of 8. Bigger batches amortise the Python
+# overhead of every gate over more blocks
+BATCH_BLOCKS = 4096
+
+
+# Transposition. The bytes of state byte j from 8 consecutive blocks form an 8x8 bit
+# matrix in one 64-bit lane of a big integer, three delta swaps transpose every lane
+# at once (Hacker's Delight transpose8), after which byte 7 - b of each lane holds bit
+# b of the 8 blocks. Block k = 8m + i ends up at bit 7 - i of byte m of every plane.
+
+def _lane_masks(n_bytes):
+    lanes = int.from_bytes(b"\0\0\0\0\0\0\0\1" * n_bytes, "big")
+    return 0x00AA00AA00AA00AA * lanes, 0x0000CCCC0000CCCC * lanes, 0x00000000F0F0F0F0 * lanes
+
+
+def _transpose(x, masks):
+    # Its own inverse
+    m1, m2, m3 = masks
+    t = (x ^ (x >> 7)) & m1
+    x ^= t ^ (t << 7)
+    t = (x ^ (x >> 14)) & m2
+    x ^= t ^ (t << 14)
+    t = (x ^ (x >> 28)) & m3
+    x ^= t ^ (t << 28)
+    return x
+
+
+def _to_planes(data, masks):
+    n_blocks = len(data) // 16
+    state = []
+    for j in range(16):
+        lanes = _transpose(int.from_bytes(data[j::16], "big"), masks).to_bytes(n_blocks, "big")
+        state.append([int.from_bytes(lanes[7 - b::8], "big") for b in range(8)])
+    return state
+
+
+def _from_planes(state, n_bytes, masks):
+    n_blocks = 8 * n_bytes
+    out = bytearray(16 * n_blocks)
+    lanes = bytearray(n_blocks)
+    for j in range(16):
+        for b in range(8):
+            lanes[7 - b::8] = state[j][b].to_bytes(n_bytes, "big")
+        out[j::16] = _transpose(int.from_bytes(lanes, "big"), masks).to_bytes(n_blocks, "big")
+    return out
+
+
+# SubBytes, Boyar-Peralta circuit (113 gates). U0 is the most significant bit
+
+def _sbox(U0, U1, U2, U3, U4, U5, U6, U7, ones):
+    T1 = U0 ^ U3
+    T2 = U0 ^ U5
+    T3 = U0 ^ U6
+    T4 = U3 ^ U5
+    T5 = U4 ^ U6
+    T6 = T1 ^ T5
+    T7 = U1 ^ U2
+    T8 = U7 ^ T6
+    T9 = U7 ^ T7
+    T10 = T6 ^ T7
+    T11 = U1 ^ U5
+    T12 = U2 ^ U5
+    T13 = T3 ^ T4
+    T14 = T6 ^ T11
+    T15 = T5 ^ T11
+    T16 = T5 ^ T12
+    T17 = T9 ^ T16
+    T18 = U3 ^ U7
+    T19 = T7 ^ T18
+    T20 = T1 ^ T19
+    T21 = U6 ^ U7
+    T22 = T7 ^ T21
+    T23 = T2 ^ T22
+    T24 = T2 ^ T10
+    T25 = T20 ^ T17
+    T26 = T3 ^ T16
+    T27 = T1 ^ T12
+
+    M1 = T13 & T6
+    M2 = T23 & T8
+    M3 = T14 ^ M1
+    M4 = T19 & U7
+    M5 = M4 ^ M1
+    M6 = T3 & T16
+    M7 = T22 & T9
+    M8 = T26 ^ M6
+    M9 = T20 & T17
+    M10 = M9 ^ M6
+    M11 = T1 & T15
+    M12 = T4 & T27
+    M13 = M12 ^ M11
+    M14 = T2 & T10
+    M15 = M14 ^ M11
+    M16 = M3 ^ M2
+    M17 = M5 ^ T24
+    M18 = M8 ^ M7
+    M19 = M10 ^ M15
+    M20 = M16 ^ M13
+    M21 = M17 ^ M15
+    M22 = M18 ^ M13
+    M23 = M19 ^ T25
+    M24 = M22 ^ M23
+    M25 = M22 & M20
+    M26 = M21 ^ M25
+    M27 = M20 ^ M21
+    M28 = M23 ^ M25
+    M29 = M28 & M27
+    M30 = M26 & M24
+    M31 = M20 & M23
+    M32 = M27 & M31
+    M33 = M27 ^ M25
+    M34 = M21 & M22
+    M35 = M24 & M34
+    M36 = M24 ^ M25
+    M37 = M21 ^ M29
+    M38 = M32 ^ M33
+    M39 = M23 ^ M30
+    M40 = M35 ^ M36
+    M41 = M38 ^ M40
+    M42 = M37 ^ M39
+    M43 = M37 ^ M38
+    M44 = M39 ^ M40
+    M45 = M42 ^ M41
+    M46 = M44 & T6
+    M47 = M40 & T8
+    M48 = M39 & U7
+    M49 = M43 & T16
+    M50 = M38 & T9
+    M51 = M37 & T17
+    M52 = M42 & T15
+    M53 = M45 & T27
+    M54 = M41 & T10
+    M55 = M44 & T13
+    M56 = M40 & T23
+    M57 = M39 & T19
+    M58 = M43 & T3
+    M59 = M38 & T22
+    M60 = M37 & T20
+    M61 = M42 & T1
+    M62 = M45 & T4
+    M63 = M41 & T2
+
+    L0 = M61 ^ M62
+    L1 = M50 ^ M56
+    L2 = M46 ^ M48
+    L3 = M47 ^ M55
+    L4 = M54 ^ M58
+    L5 = M49 ^ M61
+    L6 = M62 ^ L5
+    L7 = M46 ^ L3
+    L8 = M51 ^ M59
+    L9 = M52 ^ M53
+    L10 = M53 ^ L4
+    L11 = M60 ^ L2
+    L12 = M48 ^ M51
+    L13 = M50 ^ L0
+    L14 = M52 ^ M61
+    L15 = M55 ^ L1
+    L16 = M56 ^ L0
+    L17 = M57 ^ L1
+    L18 = M58 ^ L8
+    L19 = M63 ^ L4
+    L20 = L0 ^ L1
+    L21 = L1 ^ L7
+    L22 = L3 ^ L12
+    L23 = L18 ^ L2
+    L24 = L15 ^ L9
+    L25 = L6 ^ L10
+    L26 = L7 ^ L9
+    L27 = L8 ^ L10
+    L28 = L11 ^ L14
+    L29 = L11 ^ L17
+
+    S0 = L6 ^ L24
+    S1 = L16 ^ L26 ^ ones
+    S2 = L19 ^ L28 ^ ones
+    S3 = L6 ^ L21
+    S4 = L20 ^ L22
+    S5 = L25 ^ L29
+    S6 = L13 ^ L27 ^ ones
+    S7 = L6 ^ L23 ^ ones
+    return S0, S1, S2, S3, S4, S5, S6, S7
+
+
+def _sub_byte(planes, ones):
+    # planes are indexed by bit number (0 = least significant), the circuit by MSB first
+    s = _sbox(planes[7], planes[6], planes[5], planes[4], planes[3], planes[2], planes[1], planes[0], ones)
+    return [s[7], s[6], s[5], s[4], s[3], s[2], s[1], s[0]]
+
+
+def _inv_affine(p):
+    # Linear part of the inverse s-box affine map: bit i = x[i+2] ^ x[i+5] ^ x[i+7]
+    return [p[(i + 2) % 8] ^ p[(i + 5) % 8] ^ p[(i + 7) % 8] for i in range(8)]
+
+
+def _const_planes(const, ones):
+    # A byte broadcast to every block, -bit & ones is 0 or all ones without a branch
+    return [-((const >> b) & 1) & ones for b in range(8)]
+
+
+def _inv_sub_byte(planes, c63, ones):
+    # InvSubBytes(x) = A^-1(S(A^-1(x ^ 63)) ^ 63), with A^-1 the linear inverse affine map
+    y = _inv_affine(_xor8(planes, c63))
+    y = _sub_byte(y, ones)
+    return _inv_affine(_xor8(y, c63))
+
+
+# ShiftRows, state byte 4 * col + row
+
+_SHIFT_ROWS = [4 * ((c + r) % 4) + r for c in range(4) for r in range(4)]
+_INV_SHIFT_ROWS = [4 * ((c - r) % 4) + r for c in range(4) for r in range(4)]
+
+
+# MixColumns
+
+def _xor8(a, b):
+    return [a[0] ^ b[0], a[1] ^ b[1], a[2] ^ b[2], a[3] ^ b[3],
+            a[4] ^ b[4], a[5] ^ b[5], a[6] ^ b[6], a[7] ^ b[7]]
+
+
+def _xtime(a):
+    a7 = a[7]
+    return [a7, a[0] ^ a7, a[1], a[2] ^ a7, a[3] ^ a7, a[4], a[5], a[6]]
+
+
+def _mix_columns(state):
+    out = []
+    for c in range(0, 16, 4):
+        a0, a1, a2, a3 = state[c:c + 4]
+        t = _xor8(_xor8(a0, a1), _xor8(a2, a3))
+        out.append(_xor8(_xor8(a0, t), _xtime(_xor8(a0, a1))))
+        out.append(_xor8(_xor8(a1, t), _xtime(_xor8(a1, a2))))
+        out.append(_xor8(_xor8(a2, t), _xtime(_xor8(a2, a3))))
+        out.append(_xor8(_xor8(a3, t), _xtime(_xor8(a3, a0))))
+    return out
+
+
+def _inv_mix_columns(state):
+    # InvMixColumns = MixColumns after folding 4 * (a0 ^ a2) and 4 * (a1 ^ a3) into the column
+    pre = []
+    for c in range(0, 16, 4):
+        a0, a1, a2, a3 = state[c:c + 4]
+        u = _xtime(_xtime(_xor8(a0, a2)))
+        v = _xtime(_xtime(_xor8(a1, a3)))
+        pre += [_xor8(a0, u), _xor8(a1, v), _xor8(a2, u), _xor8(a3, v)]
+    return _mix_columns(pre)
+
+
+def _add_round_key(state, key_planes):
+    return [_xor8(state[j], key_planes[j]) for j in range(16)]
+
+
+def _key_planes(round_keys, ones):
+    # Every round key byte as 8 planes, XORed into the state unconditionally
+    return [[_const_planes(k, ones) for k in key_bytes] for key_bytes in round_keys]
+
+
+# Batch engines, data holds a multiple of 8 blocks
+
+def _encrypt_batch(round_keys, data):
+    n_bytes = len(data) // 128
+    ones = (1 << (8 * n_bytes)) - 1
+    masks = _lane_masks(n_bytes)
+    key_planes = _key_planes(round_keys, ones)
+    state = _add_round_key(_to_planes(data, masks), key_planes[0])
+
+    for r in range(1, 11):
+        state = [_sub_byte(state[j], ones) for j in _SHIFT_ROWS]
+        if r < 10:
+            state = _mix_columns(state)
+        state = _add_round_key(state, key_planes[r])
+    return _from_planes(state, n_bytes, masks)
+
+
+def _decrypt_batch(round_keys, data):
+    n_bytes = len(data) // 128
+    ones = (1 << (8 * n_bytes)) - 1
+    masks = _lane_masks(n_bytes)
+    key_planes = _key_planes(round_keys, ones)
+    c63 = _const_planes(0x63, ones)
+    state = _add_round_key(_to_planes(data, masks), key_planes[10])
+
+    for r in range(9, -1, -1):
+        state = [_inv_sub_byte(state[j], c63, ones) for j in _INV_SHIFT_ROWS]
+        state = _add_round_key(state, key_planes[r])
+        if r > 0:
+            state = _inv_mix_columns(state)
+    return _from_planes(state, n_bytes, masks)
+
+
+def _round_keys(cipher):
+    key_bytes = struct.pack(">44I", *cipher._schedule[:44])
+    return [key_bytes[16 * r:16 * r + 16] for r in range(11)]
+
+
+def _run(batch_function, cipher, data, batch_blocks):
+    if len(data) % 16:
+        raise ValueError("data length must be a multiple of 16")
+    if batch_blocks % 8:
+        raise ValueError("batch_blocks must be a multiple of 8")
+    round_keys = _round_keys(cipher)
+    data = bytes(data)
+    out = bytearray()
+    step = 16 * batch_blocks
+    for offset in range(0, len(data), step):
+        chunk = data[offset:offset + step]
+        # The transposition works on groups of 8 blocks, pad the last batch with zeros
+        padding = -len(chunk) % 128
+        out += batch_function(round_keys, chunk + bytes(padding))[:len(chunk)]
+    return bytes(out)
+
+
+def encrypt_blocks(cipher, data, batch_blocks=BATCH_BLOCKS):
+    # Same output as cipher.encrypt on every 16-byte block of data
+    return _run(_encrypt_batch, cipher, data, batch_blocks)
+
+
+def decrypt_blocks(cipher, data, batch_blocks=BATCH_BLOCKS):
+    return _run(_decrypt_batch, cipher, data, batch_blocks)
+
+
+# ECB with the same padding as AES_Encryption.encrypt_ecb / decrypt_ecb
+def encrypt_ecb(cipher, data, batch_blocks=BATCH_BLOCKS):
+    return encrypt_blocks(cipher, cipher._pad(data), batch_blocks)
+
+
+def decrypt_ecb(cipher, data, batch_blocks=BATCH_BLOCKS):
+    return cipher._unpad(decrypt_blocks(cipher, data, batch_blocks))
+
+
+# CTR with the same counter block layout as AES_Encryption.encrypt_ctr
+def encrypt_ctr(cipher, data, nonce, initial_counter=0, batch_blocks=BATCH_BLOCKS):
+    n_blocks = (len(data) + 15) // 16
+    prefix, _ = counter_mode.counter_space(nonce, 16, initial_counter, n_blocks)
+
+    counters = b"".join((prefix | (initial_counter + i)).to_bytes(16, "big") for i in range(n_blocks))
+    keystream = encrypt_blocks(cipher, counters, batch_blocks)[:len(data)]
+    if not data:
+        return b""
+    result = int.from_bytes(data, "big") ^ int.from_bytes(keystream, "big")
+    return result.to_bytes(len(data), "big")
+
+
+def decrypt_ctr(cipher, data, nonce, initial_counter=0, batch_blocks=BATCH_BLOCKS):
+    return encrypt_ctr(cipher, data, nonce, initial_counter, batch_blocks)
+
+
+# Checks the FIPS-197 example block and random data against the table based cipher
+def run_test():
+    import os
+    from aes_encryption import AES_Encryption
+
+    print("Running bitsliced AES unit test")
+    cipher = AES_Encryption(bytes.fromhex("000102030405060708090a0b0c0d0e0f"))
+    plaintext = bytes.fromhex("00112233445566778899aabbccddeeff")
+    ciphertext = bytes.fromhex("69c4e0d86a7b0430d8cdb78070b4c55a")
+    if encrypt_blocks(cipher, plaintext) != ciphertext:
+        print("Test failed in encryption mode")
+        return False
+    if decrypt_blocks(cipher, ciphertext) != plaintext:
+        print("Test failed in decryption mode")
+        return False
+
+    cipher = AES_Encryption(os.urandom(16))
+    data = os.urandom(1000)
+    nonce = os.urandom(8)
+    if encrypt_ecb(cipher, data, 64) != bytes(cipher.encrypt_ecb(data)):
+        print("Test failed in ECB mode")
+        return False
+    if encrypt_ctr(cipher, data, nonce, 5, 64) != bytes(cipher.encrypt_ctr(data, nonce, 5)):
+        print("Test failed in CTR mode")
+        return False
+    print("Test OK")
+    return True
+
+
+if __name__ == "__main__":
+    run_test()
@@ -0,0 +1,120 @@
+# Key schedule cache and batch ECB for workloads with many keys and short records.
+#
+#   ciphertexts = aes_cache.encrypt_many([(key_a, b"record 1"), (key_b, b"record 2"), ...])
+#   plaintexts = aes_cache.decrypt_many(zip(keys, ciphertexts))
+#
+# Expanded ciphers are kept in a bounded LRU keyed by a keyed BLAKE2 digest of the AES
+# key, so the raw keys are never used as dictionary keys. The digest key is random per
+# cache and never leaves the process.
+
+import hashlib
+import os
+
+import instrumentation
+import lru
+from aes_encryption import AES_Encryption
+
+DEFAULT_MAX_SIZE = 4096
+
+
+class KeyScheduleCache(lru.LRUCache):
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        super().__init__(max_size)
+        self._salt = os.urandom(16)
+        self.misses = 0
+
+    def _digest(self, key):
+        return hashlib.blake2b(bytes(key), key=self._salt, digest_size=16).digest()
+
+    def get(self, key):
+        # The cipher for key, expanding and inserting it on a miss
+        digest = self._digest(key)
+        cipher = self._lookup(digest)
+        if cipher is not None:
+            if instrumentation.enabled:
+                instrumentation.record("aes_cache.hit")
+            return cipher
+
+        # Expand outside the lock, two threads missing on the same key both do the work
+        cipher = AES_Encryption(key)
+        with self._lock:
+            self.misses += 1
+        evicted = self._insert(digest, cipher)
+        if instrumentation.enabled:
+            instrumentation.record("aes_cache.miss")
+            if evicted:
+                instrumentation.record("aes_cache.eviction", evicted)
+        return cipher
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats["misses"] = self.misses
+        return stats
+
+
+# Process wide cache used by the batch functions when none is given
+default_cache = KeyScheduleCache()
+
+
+def get_cipher(key):
+    return default_cache.get(key)
+
+
+def _group_by_key(records, cache):
+    # {digest: (key, [index, ...])} in first-seen order, so every key is looked up once
+    # per batch. Grouped by the cache's digest, the raw key is only kept as a value
+    groups = {}
+    items = []
+    for index, (key, data) in enumerate(records):
+        digest = cache._digest(key)
+        if digest not in groups:
+            groups[digest] = (key, [])
+        groups[digest][1].append(index)
+        items.append(data)
+    return groups, items
+
+
+def encrypt_many(records, cache=None):
+    # ECB with PKCS#7 padding for every (key, data) pair, the same output as
+    # AES_Encryption(key).encrypt_ecb(data). Records sharing a key are padded,
+    # joined and encrypted in one encrypt_into call, results keep the input order
+    cache = default_cache if cache is None else cache
+    groups, items = _group_by_key(records, cache)
+    results = [None] * len(items)
+
+    for key, indices in groups.values():
+        cipher = cache.get(key)
+        pad = cipher._pad
+        padded = [pad(bytes(items[i])) for i in indices]
+        joined = bytearray(b"".join(padded))
+        cipher.encrypt_into(joined, joined)
+
+        view = memoryview(joined)
+        offset = 0
+        for i, block in zip(indices, padded):
+            results[i] = bytes(view[offset:offset + len(block)])
+            offset += len(block)
+    return results
+
+
+def decrypt_many(records, cache=None):
+    cache = default_cache if cache is None else cache
+    groups, items = _group_by_key(records, cache)
+    results = [None] * len(items)
+
+    for key, indices in groups.values():
+        cipher = cache.get(key)
+        parts = [bytes(items[i]) for i in indices]
+        for part in parts:
+            if not part or len(part) % 16:
+                raise ValueError("ciphertext length must be a non-zero multiple of 16")
+        joined = bytearray(b"".join(parts))
+        cipher.decrypt_into(joined, joined)
+
+        unpad = cipher._unpad
+        offset = 0
+        for i, part in zip(indices, parts):
+            results[i] = bytes(unpad(joined[offset:offset + len(part)]))
+            offset += len(part)
+    return results
@@ -1,213 +1,261 @@
+import struct
+from array import array
+
 import aes_base_tables
+import counter_mode
+import instrumentation
+import parallel
+
+# Bytes per worker job when CTR runs on a pool
+CTR_CHUNK_SIZE = 1 << 20
 
 class AES_Encryption:
+    # Only the round keys live on the instance, every constant table is shared
+    __slots__ = ("_schedule",)
+
+    s_box = aes_base_tables.base_sbox
+    inv_box = aes_base_tables.base_inv_sbox
+    rcon = aes_base_tables.base_rcon
+
     def __init__(self, key):
+        if len(key) != 16:
+            raise ValueError("key must be 16 bytes long")
+        start = instrumentation.now() if instrumentation.enabled else None
 
-        # Initialize base vectors
-        self.s_box = aes_base_tables.base_sbox.copy()
-        self.rcon = aes_base_tables.base_rcon.copy()
-        self.galois2 = aes_base_tables.galois2.copy()
-        self.galois3 = aes_base_tables.galois3.copy()
-        self.galois9 = aes_base_tables.galois9.copy()
-        self.galois11 = aes_base_tables.galois11.copy()
-        self.galois13 = aes_base_tables.galois13.copy()
-        self.galois14 = aes_base_tables.galois14.copy()
-
-        # Key expansion
-        self.round_keys = self._key_expansion(bytearray(key))
-
-        # Generate inverse s-box
-        self.inv_box = bytearray(256)
-        for i in range(256):
-            sbox_value = self.s_box[i]
-            self.inv_box[sbox_value] = i
+        # Key expansion, the encryption words followed by the decryption words
+        # for the equivalent inverse cipher, in one array of 32-bit words
+        enc_words = self._key_expansion(key)
+        self._schedule = array("I", enc_words + self._inv_key_schedule(enc_words))
+
+        if start is not None:
+            instrumentation.record("aes.key_setup", 1, instrumentation.elapsed(start))
+
+    @property
+    def round_keys(self):
+        schedule = self._schedule
+        round_keys = []
+        for k in range(0, 44, 4):
+            round_keys.append(bytearray(struct.pack(">4I", *schedule[k:k + 4])))
+        return round_keys
 
-    
     #Helpers
     def _rot_word(self, word):
-        return word[1:] + word[:1]
+        return ((word << 8) & 0xFFFFFFFF) | (word >> 24)
     
     def _sub_word(self, word):
-        new_word = []
-        for b in word:
-            new_word.append(self.s_box[b])
-        return bytearray(new_word)
-
-    def _xor_words(self, w1, w2):
-        return bytearray(a ^ b for a, b in zip(w1, w2))
-
-    def _xtime(self, b):
-        if b & 0x80:
-            return ((b << 1) ^ 0x1b) & 0xFF
-        return (b << 1) & 0xFF
-    
+        sb = self.s_box
+        return sb[word >> 24] << 24 | sb[(word >> 16) & 0xFF] << 16 | sb[(word >> 8) & 0xFF] << 8 | sb[word & 0xFF]
+
     def _pad(self, data):
+        start = instrumentation.now() if instrumentation.enabled else None
         pad_len = 16 - (len(data) % 16)
-        return data + bytes([pad_len] * pad_len)
+        padded = data + bytes([pad_len] * pad_len)
+        if start is not None:
+            instrumentation.record("aes.padding", 1, instrumentation.elapsed(start))
+        return padded
     
     def _unpad(self, data):
+        start = instrumentation.now() if instrumentation.enabled else None
         pad_len = data[-1]
-        return data[:-pad_len]
-    
-    # Bytes substitution and inverse version
-    def _sub_bytes(self, state, s_box):
-        for i in range(16):
-            state[i] = s_box[state[i]]
-        return state
+        unpadded = data[:-pad_len]
+        if start is not None:
+            instrumentation.record("aes.padding", 1, instrumentation.elapsed(start))
+        return unpadded
     
-    def _inv_sub_bytes(self, state, inv_s_box):
-        for i in range(16):
-            state[i] = inv_s_box[state[i]]
-        return state
-
-    # Shiftrows and inverse version
-    def _shiftrows(self, s):
-        #row 1
-        s[1] , s[5], s[9], s[13] = s[5], s[9], s[13], s[1]
-        #row 2
-        s[2], s[6], s[10], s[14] = s[10], s[14], s[2], s[6]
-        #row 3
-        s[3], s[7], s[11], s[15] = s[15], s[3], s[7], s[11]
-        return s
-
-    def _inv_shiftrows(self, s):
-        #row 1
-        s[1], s[5], s[9], s[13] = s[13], s[1], s[5], s[9]
-        #row 2
-        s[2], s[6], s[10], s[14] = s[10], s[14], s[2], s[6]
-        #row 3
-        s[3], s[7], s[11], s[15] = s[7], s[11], s[15], s[3]
-        return s
-
-    # MixColumns step and inverse
-    def _mix_columns(self, state):
-        for i in range(4):
-            base = i * 4
-
-            a0 = state[base]
-            a1 = state[base + 1]
-            a2 = state[base + 2]
-            a3 = state[base + 3]
-
-            state[base] = self._xtime(a0) ^ (self._xtime(a1) ^ a1) ^ a2 ^ a3
-            state[base + 1] = a0 ^ self._xtime(a1) ^ (self._xtime(a2) ^ a2) ^ a3
-            state[base + 2] = a0 ^ a1 ^ self._xtime(a2) ^ (self._xtime(a3) ^ a3)
-            state[base + 3] = (self._xtime(a0) ^ a0) ^ a1 ^ a2 ^ self._xtime(a3)
-        return state
-
-    def _inv_mix_columns(self, state):
-        for i in range(4):
-            base = i * 4
-            a0 = state[base]
-            a1 = state[base + 1]
-            a2 = state[base + 2]
-            a3 = state[base + 3]
-
-            state[base]     = self.galois14[a0] ^ self.galois11[a1] ^ self.galois13[a2] ^ self.galois9[a3]
-            state[base + 1] = self.galois9[a0]  ^ self.galois14[a1] ^ self.galois11[a2] ^ self.galois13[a3]
-            state[base + 2] = self.galois13[a0] ^ self.galois9[a1]  ^ self.galois14[a2] ^ self.galois11[a3]
-            state[base + 3] = self.galois11[a0] ^ self.galois13[a1] ^ self.galois9[a2]  ^ self.galois14[a3]
-        return state
-
-    def _add_round_key(self, state, key):
-        for i in range(16):
-            state[i] ^= key[i]
-        return state
-
      #Key expansion
     
     def _key_expansion(self, key):
-        words= []
+        words = list(struct.unpack(">4I", key))
 
-        for i in range(4):
-            word = key[i*4 : (i+1) *4 ]
-            words.append(bytearray(word))
-            
         for i in range(4,44):
-            temp = words[i-1].copy()
+            temp = words[i-1]
 
             if i % 4 == 0:
                 temp = self._rot_word(temp)
                 temp = self._sub_word(temp)
-                temp[0] ^= self.rcon[(i // 4) - 1]
-
-            new_word = self._xor_words(words[i-4], temp)
-            words.append(new_word)
-
-        round_keys = []
-        for i in range(0, 44, 4):
-            rk = bytearray()
-            for j in range(4):
-                rk.extend(words[i + j])
-            round_keys.append(rk)
-                
-        return round_keys
-
-    def _split_blocks(self, data):
-        blocks = []
-        for i in range(0, len(data), 16):
-            blocks.append(data[i:i+16])
-        return blocks
+                temp ^= self.rcon[(i // 4) - 1] << 24
+
+            words.append(words[i-4] ^ temp)
+
+        return words
+
+    # Reverse the round keys and run InvMixColumns over the middle ones, so that
+    # decryption can use the same round structure as encryption
+    def _inv_key_schedule(self, enc_words):
+        Td0 = aes_base_tables.Td0
+        Td1 = aes_base_tables.Td1
+        Td2 = aes_base_tables.Td2
+        Td3 = aes_base_tables.Td3
+        sb = self.s_box
+
+        dec_words = []
+        for k in range(40, -4, -4):
+            for w in enc_words[k:k + 4]:
+                if 0 < k < 40:
+                    # Td[S[x]] is InvMixColumns of a single byte
+                    w = Td0[sb[w >> 24]] ^ Td1[sb[(w >> 16) & 0xFF]] ^ Td2[sb[(w >> 8) & 0xFF]] ^ Td3[sb[w & 0xFF]]
+                dec_words.append(w)
+        return dec_words
 
     def encrypt_ecb(self, data):
         state = self._pad(data)
-        blocks = self._split_blocks(state)
-
-        result = bytearray()
-
-        for block in blocks:
-            encrypted = self.encrypt(block)
-            result.extend(encrypted)
+        result = bytearray(len(state))
+        self.encrypt_into(state, result)
         return result
     
     def decrypt_ecb(self, data):
-        blocks = self._split_blocks(data)
-        result = bytearray()
-
-        for block in  blocks:
-            decrypted = self.decrypt(block)
-            result.extend(decrypted)
+        result = bytearray(len(data))
+        self.decrypt_into(data, result)
         result = self._unpad(result)
         return bytes(result)
 
-    # ENCRYPTION CALL
-    def encrypt(self, plain_text_bytes):
-        state = bytearray(plain_text_bytes)
-    
-        # Step 0
-        state = self._add_round_key(state, self.round_keys[0])
+    # In place ECB over buffer protocol objects (bytearray, memoryview, mmap, NumPy arrays).
+    # dst may be the same buffer as src, returns the number of bytes written
+    def encrypt_into(self, src, dst):
+        start = instrumentation.now() if instrumentation.enabled else None
+        length = self._transform_into(self._encrypt_words, src, dst)
+        if start is not None:
+            instrumentation.record("aes.encrypt_blocks", length // 16, instrumentation.elapsed(start))
+        return length
+
+    def decrypt_into(self, src, dst):
+        start = instrumentation.now() if instrumentation.enabled else None
+        length = self._transform_into(self._decrypt_words, src, dst)
+        if start is not None:
+            instrumentation.record("aes.decrypt_blocks", length // 16, instrumentation.elapsed(start))
+        return length
+
+    def _transform_into(self, words_function, src, dst):
+        src = memoryview(src).cast("B")
+        dst = memoryview(dst).cast("B")
+        length = len(src)
+        if length % 16:
+            raise ValueError("source length must be a multiple of 16")
+        if len(dst) < length:
+            raise ValueError("destination buffer is too small")
+
+        # Every block is read completely before it is written, so src is dst is fine
+        unpack_from = struct.unpack_from
+        pack_into = struct.pack_into
+        for offset in range(0, length, 16):
+            pack_into(">4I", dst, offset, *words_function(*unpack_from(">4I", src, offset)))
+        return length
+
+    # CTR mode with the counter block layout of counter_mode
+    def encrypt_ctr(self, data, nonce, initial_counter=0, executor=None, chunk_size=CTR_CHUNK_SIZE):
+        prefix, _ = counter_mode.counter_space(nonce, 16, initial_counter, (len(data) + 15) // 16)
+
+        # Small payloads are not worth shipping to the pool
+        if executor is None or len(data) <= chunk_size:
+            result = bytearray(data)
+            self._ctr_xor(result, prefix, initial_counter, 0, len(result))
+            return bytes(result)
+
+        jobs = []
+        for start, end in parallel.split_range(len(data), chunk_size, 16):
+            jobs.append((self, prefix, initial_counter + start // 16, start, end))
+        return parallel.run_shared(executor, data, _ctr_worker, jobs)
+
+    def decrypt_ctr(self, data, nonce, initial_counter=0, executor=None, chunk_size=CTR_CHUNK_SIZE):
+        return self.encrypt_ctr(data, nonce, initial_counter, executor, chunk_size)
+
+    # XOR the keystream into buf[start:end] in place, counter belongs to the block at start
+    # Statistics are recorded in the process that runs it, pool workers keep their own
+    def _ctr_xor(self, buf, prefix, counter, start, end):
+        timer = instrumentation.now() if instrumentation.enabled else None
+
+        encrypt_words = self._encrypt_words
+        full_end = start + (end - start) // 16 * 16
+        for offset in range(start, end, 16):
+            block = prefix | counter
+            k0, k1, k2, k3 = encrypt_words(block >> 96, (block >> 64) & 0xFFFFFFFF,
+                                           (block >> 32) & 0xFFFFFFFF, block & 0xFFFFFFFF)
+            counter += 1
+
+            if offset < full_end:
+                d0, d1, d2, d3 = struct.unpack_from(">4I", buf, offset)
+                struct.pack_into(">4I", buf, offset, d0 ^ k0, d1 ^ k1, d2 ^ k2, d3 ^ k3)
+            else:
+                # Trailing partial block
+                keystream = struct.pack(">4I", k0, k1, k2, k3)
+                for i in range(end - offset):
+                    buf[offset + i] ^= keystream[i]
+
+        if timer is not None:
+            instrumentation.record("aes.ctr_blocks", (end - start + 15) // 16, instrumentation.elapsed(timer))
+
+    # T-table round function, works on the four big-endian column words of the state
+    def _encrypt_words(self, s0, s1, s2, s3):
+        Te0 = aes_base_tables.Te0
+        Te1 = aes_base_tables.Te1
+        Te2 = aes_base_tables.Te2
+        Te3 = aes_base_tables.Te3
+        ek = self._schedule
 
-        # Step 1 - 10
-        for r in range(1, 10):
-            state = self._sub_bytes(state, self.s_box)
-            state = self._shiftrows(state)
-            state = self._mix_columns(state)
-            state = self._add_round_key(state, self.round_keys[r])
+        # Step 0
+        s0 ^= ek[0]
+        s1 ^= ek[1]
+        s2 ^= ek[2]
+        s3 ^= ek[3]
+
+        # Step 1 - 10, SubBytes + ShiftRows + MixColumns folded into the table lookups
+        for k in range(4, 40, 4):
+            t0 = Te0[s0 >> 24] ^ Te1[(s1 >> 16) & 0xFF] ^ Te2[(s2 >> 8) & 0xFF] ^ Te3[s3 & 0xFF] ^ ek[k]
+            t1 = Te0[s1 >> 24] ^ Te1[(s2 >> 16) & 0xFF] ^ Te2[(s3 >> 8) & 0xFF] ^ Te3[s0 & 0xFF] ^ ek[k + 1]
+            t2 = Te0[s2 >> 24] ^ Te1[(s3 >> 16) & 0xFF] ^ Te2[(s0 >> 8) & 0xFF] ^ Te3[s1 & 0xFF] ^ ek[k + 2]
+            t3 = Te0[s3 >> 24] ^ Te1[(s0 >> 16) & 0xFF] ^ Te2[(s1 >> 8) & 0xFF] ^ Te3[s2 & 0xFF] ^ ek[k + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+
+        # Step 11, no MixColumns so only the s-box is used
+        sb = self.s_box
+        t0 = (sb[s0 >> 24] << 24 | sb[(s1 >> 16) & 0xFF] << 16 | sb[(s2 >> 8) & 0xFF] << 8 | sb[s3 & 0xFF]) ^ ek[40]
+        t1 = (sb[s1 >> 24] << 24 | sb[(s2 >> 16) & 0xFF] << 16 | sb[(s3 >> 8) & 0xFF] << 8 | sb[s0 & 0xFF]) ^ ek[41]
+        t2 = (sb[s2 >> 24] << 24 | sb[(s3 >> 16) & 0xFF] << 16 | sb[(s0 >> 8) & 0xFF] << 8 | sb[s1 & 0xFF]) ^ ek[42]
+        t3 = (sb[s3 >> 24] << 24 | sb[(s0 >> 16) & 0xFF] << 16 | sb[(s1 >> 8) & 0xFF] << 8 | sb[s2 & 0xFF]) ^ ek[43]
+        return t0, t1, t2, t3
 
-        # Step 11
-        state = self._sub_bytes(state, self.s_box)
-        state = self._shiftrows(state)
-        state = self._add_round_key(state, self.round_keys[10])
-        return state
+    # ENCRYPTION CALL
+    def encrypt(self, plain_text_bytes):
+        start = instrumentation.now() if instrumentation.enabled else None
+        words = self._encrypt_words(*struct.unpack(">4I", plain_text_bytes))
+        if start is not None:
+            instrumentation.record("aes.encrypt_blocks", 1, instrumentation.elapsed(start))
+        return bytearray(struct.pack(">4I", *words))
+
+    # Equivalent inverse cipher, same layout as _encrypt_words with the Td tables
+    def _decrypt_words(self, s0, s1, s2, s3):
+        Td0 = aes_base_tables.Td0
+        Td1 = aes_base_tables.Td1
+        Td2 = aes_base_tables.Td2
+        Td3 = aes_base_tables.Td3
+        dk = self._schedule
+
+        s0 ^= dk[44]
+        s1 ^= dk[45]
+        s2 ^= dk[46]
+        s3 ^= dk[47]
+
+        for k in range(48, 84, 4):
+            t0 = Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 0xFF] ^ Td2[(s2 >> 8) & 0xFF] ^ Td3[s1 & 0xFF] ^ dk[k]
+            t1 = Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 0xFF] ^ Td2[(s3 >> 8) & 0xFF] ^ Td3[s2 & 0xFF] ^ dk[k + 1]
+            t2 = Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 0xFF] ^ Td2[(s0 >> 8) & 0xFF] ^ Td3[s3 & 0xFF] ^ dk[k + 2]
+            t3 = Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 0xFF] ^ Td2[(s1 >> 8) & 0xFF] ^ Td3[s0 & 0xFF] ^ dk[k + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+
+        ib = self.inv_box
+        t0 = (ib[s0 >> 24] << 24 | ib[(s3 >> 16) & 0xFF] << 16 | ib[(s2 >> 8) & 0xFF] << 8 | ib[s1 & 0xFF]) ^ dk[84]
+        t1 = (ib[s1 >> 24] << 24 | ib[(s0 >> 16) & 0xFF] << 16 | ib[(s3 >> 8) & 0xFF] << 8 | ib[s2 & 0xFF]) ^ dk[85]
+        t2 = (ib[s2 >> 24] << 24 | ib[(s1 >> 16) & 0xFF] << 16 | ib[(s0 >> 8) & 0xFF] << 8 | ib[s3 & 0xFF]) ^ dk[86]
+        t3 = (ib[s3 >> 24] << 24 | ib[(s2 >> 16) & 0xFF] << 16 | ib[(s1 >> 8) & 0xFF] << 8 | ib[s0 & 0xFF]) ^ dk[87]
+        return t0, t1, t2, t3
 
     #DECRYPTION CALL
     def decrypt(self, cipher_text):
-        state = bytearray(cipher_text)
-
-        state = self._add_round_key(state, self.round_keys[10])
-
-        for r in range(9, 0, -1):
-            state = self._inv_shiftrows(state)
-            state = self._inv_sub_bytes(state, self.inv_box)
-
-            state = self._add_round_key(state, self.round_keys[r])
-            state = self._inv_mix_columns(state) 
-
-        state = self._inv_shiftrows(state)
-        state = self._inv_sub_bytes(state, self.inv_box)
-
-        state = self._add_round_key(state, self.round_keys[0])
-        return state
+        start = instrumentation.now() if instrumentation.enabled else None
+        words = self._decrypt_words(*struct.unpack(">4I", cipher_text))
+        if start is not None:
+            instrumentation.record("aes.decrypt_blocks", 1, instrumentation.elapsed(start))
+        return bytearray(struct.pack(">4I", *words))
     
     def test():
         aes = AES_Encryption(b"Thats my Kung Fu")
@@ -222,16 +270,22 @@ class AES_Encryption:
 
             if decipher == plain_text:
                 print("Decryption successfull")
+                return True
             else:
                 print("Decryption failed")
         else:
             print("Encription Failed")
+        return False
 
 
-AES_Encryption.test()
-
-
-
+def _ctr_worker(shm_name, cipher, prefix, counter, start, end):
+    shm = parallel.attach_shared(shm_name)
+    try:
+        cipher._ctr_xor(shm.buf, prefix, counter, start, end)
+    finally:
+        shm.close()
 
 
+if __name__ == "__main__":
+    AES_Encryption.test()
 
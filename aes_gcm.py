@@ -0,0 +1,320 @@
+# AES-GCM on top of AES_Encryption.
+#
+# CTR encryption and GHASH run in the same pass over the data. GHASH multiplies by the
+# hash key H through a per-key table: for every byte position i of a 128-bit block and
+# every byte value b, tables[i][b] holds (b at position i) * H in GF(2^128), so one
+# multiplication is 16 lookups and XORs instead of a 128 step shift-and-add loop.
+
+import hmac
+import os
+import struct
+
+import streaming
+from aes_encryption import AES_Encryption
+
+TAG_SIZE = 16
+# Nonce size used by the file helpers
+NONCE_SIZE = 12
+# Bytes read per iteration by the file helpers
+CHUNK_SIZE = 64 * 1024
+
+# GCM reduction constant, x^128 + x^7 + x^2 + x + 1 in the reflected bit order
+_R = 0xE1 << 120
+
+
+class InvalidTag(Exception):
+    pass
+
+
+def _build_ghash_tables(h):
+    # powers[k] = H * x^k, bit k of a block being the k-th most significant bit
+    powers = []
+    v = h
+    for _ in range(128):
+        powers.append(v)
+        v = (v >> 1) ^ _R if v & 1 else v >> 1
+
+    tables = []
+    for i in range(16):
+        table = [0] * 256
+        for j in range(8):
+            bit = 1 << j
+            v = powers[8 * i + 7 - j]
+            for b in range(bit):
+                table[b | bit] = table[b] ^ v
+        tables.append(tuple(table))
+    return tuple(tables)
+
+
+class AES_GCM:
+    def __init__(self, key):
+        self.cipher = AES_Encryption(key)
+        h = int.from_bytes(self.cipher.encrypt(bytes(16)), "big")
+        self._tables = _build_ghash_tables(h)
+
+    def _mul_h(self, x):
+        z = 0
+        for table, b in zip(self._tables, x.to_bytes(16, "big")):
+            z ^= table[b]
+        return z
+
+    def _ghash(self, y, data):
+        # Fold data (zero padded to whole blocks) into the running hash y
+        mul_h = self._mul_h
+        for offset in range(0, len(data), 16):
+            y = mul_h(y ^ int.from_bytes(data[offset:offset + 16].ljust(16, b"\0"), "big"))
+        return y
+
+    def _initial_counter(self, nonce):
+        if len(nonce) == 0:
+            raise ValueError("nonce must not be empty")
+        if len(nonce) == 12:
+            return int.from_bytes(nonce, "big") << 32 | 1
+        y = self._ghash(0, nonce)
+        return self._mul_h(y ^ len(nonce) * 8)
+
+    def encryptor(self, nonce):
+        return GCM_Encryptor(self, nonce)
+
+    def decryptor(self, nonce):
+        return GCM_Decryptor(self, nonce)
+
+    # One-shot API, the tag is appended to the ciphertext
+    def encrypt(self, nonce, data, associated_data=None):
+        encryptor = self.encryptor(nonce)
+        if associated_data:
+            encryptor.authenticate_additional_data(associated_data)
+        return encryptor.update(data) + encryptor.finalize() + encryptor.tag
+
+    def decrypt(self, nonce, data, associated_data=None):
+        if len(data) < TAG_SIZE:
+            raise InvalidTag("ciphertext is shorter than the tag")
+        decryptor = self.decryptor(nonce)
+        if associated_data:
+            decryptor.authenticate_additional_data(associated_data)
+        return decryptor.update(data[:-TAG_SIZE]) + decryptor.finalize(data[-TAG_SIZE:])
+
+
+class _GCM_Context:
+    _encrypting = True
+
+    def __init__(self, gcm, nonce):
+        self._gcm = gcm
+        j0 = gcm._initial_counter(nonce)
+        self._j0 = j0
+        self._prefix = j0 & ~0xFFFFFFFF
+        self._counter = (j0 + 1) & 0xFFFFFFFF
+        self._hash = 0
+        self._aad_len = 0
+        self._aad_pending = b""
+        self._data_len = 0
+        self._pending = b""
+        # Set by the first update() or finalize(), the AAD is closed from then on
+        self._started = False
+        self._finalized = False
+
+    def authenticate_additional_data(self, data):
+        if self._started:
+            raise ValueError("additional data must come before update()")
+        self._aad_len += len(data)
+        data = self._aad_pending + bytes(data)
+        full = len(data) - len(data) % 16
+        self._hash = self._gcm._ghash(self._hash, data[:full])
+        self._aad_pending = data[full:]
+
+    def _close_aad(self):
+        if self._aad_pending:
+            self._hash = self._gcm._ghash(self._hash, self._aad_pending)
+            self._aad_pending = b""
+
+    def update(self, data):
+        if self._finalized:
+            raise ValueError("context already finalized")
+        self._started = True
+        self._close_aad()
+        data = self._pending + bytes(data)
+        full = len(data) - len(data) % 16
+        self._pending = data[full:]
+        self._data_len += full
+        return self._crypt_blocks(data, full)
+
+    def _crypt_blocks(self, data, length):
+        # CTR and GHASH over whole blocks of data[:length], GHASH always sees the ciphertext
+        out = bytearray(length)
+        encrypt_words = self._gcm.cipher._encrypt_words
+        mul_h = self._gcm._mul_h
+        prefix = self._prefix
+        counter = self._counter
+        y = self._hash
+        encrypting = self._encrypting
+        unpack_from = struct.unpack_from
+        pack_into = struct.pack_into
+
+        for offset in range(0, length, 16):
+            block = prefix | counter
+            counter = (counter + 1) & 0xFFFFFFFF
+            k0, k1, k2, k3 = encrypt_words(block >> 96, (block >> 64) & 0xFFFFFFFF,
+                                           (block >> 32) & 0xFFFFFFFF, block & 0xFFFFFFFF)
+            d0, d1, d2, d3 = unpack_from(">4I", data, offset)
+            c0 = d0 ^ k0
+            c1 = d1 ^ k1
+            c2 = d2 ^ k2
+            c3 = d3 ^ k3
+            pack_into(">4I", out, offset, c0, c1, c2, c3)
+            if encrypting:
+                y = mul_h(y ^ (c0 << 96 | c1 << 64 | c2 << 32 | c3))
+            else:
+                y = mul_h(y ^ (d0 << 96 | d1 << 64 | d2 << 32 | d3))
+
+        self._counter = counter
+        self._hash = y
+        return bytes(out)
+
+    def _finish(self):
+        # Trailing partial block, then the length block and the tag
+        self._started = True
+        self._close_aad()
+        tail = self._pending
+        self._pending = b""
+        out = b""
+        if tail:
+            block = self._prefix | self._counter
+            keystream = self._gcm.cipher.encrypt(block.to_bytes(16, "big"))
+            out = bytes(a ^ b for a, b in zip(tail, keystream))
+            self._hash = self._gcm._ghash(self._hash, out if self._encrypting else tail)
+            self._data_len += len(tail)
+
+        lengths = (self._aad_len * 8) << 64 | self._data_len * 8
+        s = self._gcm._mul_h(self._hash ^ lengths)
+        mask = int.from_bytes(self._gcm.cipher.encrypt(self._j0.to_bytes(16, "big")), "big")
+        self._finalized = True
+        return out, (s ^ mask).to_bytes(16, "big")
+
+
+class GCM_Encryptor(_GCM_Context):
+    tag = None
+
+    def finalize(self):
+        if self._finalized:
+            raise ValueError("context already finalized")
+        out, self.tag = self._finish()
+        return out
+
+
+class GCM_Decryptor(_GCM_Context):
+    _encrypting = False
+
+    def finalize(self, tag):
+        if self._finalized:
+            raise ValueError("context already finalized")
+        out, expected = self._finish()
+        if not hmac.compare_digest(expected, bytes(tag)):
+            raise InvalidTag("authentication tag mismatch")
+        return out
+
+
+# File format for the helpers below: a random 12-byte nonce, the ciphertext, then the tag
+
+class _FileEncryptor:
+    def __init__(self, gcm):
+        nonce = os.urandom(NONCE_SIZE)
+        self._encryptor = gcm.encryptor(nonce)
+        self._header = nonce
+
+    def update(self, chunk):
+        out = self._header + self._encryptor.update(chunk)
+        self._header = b""
+        return out
+
+    def finalize(self):
+        out = self._header + self._encryptor.finalize()
+        self._header = b""
+        return out + self._encryptor.tag
+
+
+class _FileDecryptor:
+    def __init__(self, gcm):
+        self._gcm = gcm
+        self._decryptor = None
+        self._pending = b""
+
+    def update(self, chunk):
+        data = self._pending + bytes(chunk)
+        if self._decryptor is None:
+            if len(data) < NONCE_SIZE:
+                self._pending = data
+                return b""
+            self._decryptor = self._gcm.decryptor(data[:NONCE_SIZE])
+            data = data[NONCE_SIZE:]
+        # The last TAG_SIZE bytes may be the tag, keep them until finalize
+        split = max(len(data) - TAG_SIZE, 0)
+        self._pending = data[split:]
+        return self._decryptor.update(data[:split])
+
+    def finalize(self):
+        if self._decryptor is None or len(self._pending) != TAG_SIZE:
+            raise InvalidTag("ciphertext is truncated")
+        return self._decryptor.finalize(self._pending)
+
+
+# src and dst are binary file-like objects, return the bytes written. decrypt_file
+# writes plaintext before the tag is checked, so on InvalidTag the caller has to
+# discard everything written to dst
+def encrypt_file(gcm, src, dst, chunk_size=CHUNK_SIZE):
+    return streaming.pump(_FileEncryptor(gcm), src, dst, chunk_size)
+
+
+def decrypt_file(gcm, src, dst, chunk_size=CHUNK_SIZE):
+    return streaming.pump(_FileDecryptor(gcm), src, dst, chunk_size)
+
+
+# Known answer tests from the original GCM specification (test cases 2 to 4)
+def run_test():
+    print("Running AES-GCM unit test")
+    key = bytes.fromhex("feffe9928665731c6d6a8f9467308308")
+    nonce = bytes.fromhex("cafebabefacedbaddecaf888")
+    plaintext = bytes.fromhex(
+        "d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72"
+        "1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b391aafd255")
+    ciphertext = bytes.fromhex(
+        "42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e"
+        "21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091473f5985")
+    aad = bytes.fromhex("feedfacedeadbeeffeedfacedeadbeefabaddad2")
+
+    cases = [
+        (bytes(16), bytes(12), bytes(16), b"",
+         bytes.fromhex("0388dace60b6a392f328c2b971b2fe78"), bytes.fromhex("ab6e47d42cec13bdf53a67b21257bddf")),
+        (key, nonce, plaintext, b"", ciphertext, bytes.fromhex("4d5c2af327cd64a62cf35abd2ba6fab4")),
+        (key, nonce, plaintext[:60], aad, ciphertext[:60], bytes.fromhex("5bc94fbc3221a5db94fae95ae7121a47")),
+    ]
+    for key, nonce, plaintext, aad, expected, tag in cases:
+        gcm = AES_GCM(key)
+        sealed = gcm.encrypt(nonce, plaintext, aad)
+        if sealed != expected + tag:
+            print("Test failed in encryption mode")
+            return False
+        try:
+            opened = gcm.decrypt(nonce, sealed, aad)
+        except InvalidTag:
+            opened = None
+        if opened != plaintext:
+            print("Test failed in decryption mode")
+            return False
+
+    # Additional data is closed by the first update(), even an empty one
+    encryptor = AES_GCM(key).encryptor(nonce)
+    encryptor.authenticate_additional_data(b"abc")
+    encryptor.update(b"")
+    try:
+        encryptor.authenticate_additional_data(b"def")
+    except ValueError:
+        pass
+    else:
+        print("Test failed, additional data accepted after update()")
+        return False
+    print("Test OK")
+    return True
+
+
+if __name__ == "__main__":
+    run_test()
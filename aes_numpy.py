@@ -0,0 +1,143 @@
+# Batched AES over (N, 16) uint8 block arrays, every round processes all blocks at once.
+# NumPy is optional, the rest of the project does not need it.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import aes_base_tables
+
+if np is not None:
+    _SBOX = np.frombuffer(aes_base_tables.base_sbox, dtype=np.uint8)
+    _INV_SBOX = np.frombuffer(aes_base_tables.base_inv_sbox, dtype=np.uint8)
+    _G2 = np.array(aes_base_tables.galois2, dtype=np.uint8)
+    _G3 = np.array(aes_base_tables.galois3, dtype=np.uint8)
+    _G9 = np.array(aes_base_tables.galois9, dtype=np.uint8)
+    _G11 = np.array(aes_base_tables.galois11, dtype=np.uint8)
+    _G13 = np.array(aes_base_tables.galois13, dtype=np.uint8)
+    _G14 = np.array(aes_base_tables.galois14, dtype=np.uint8)
+
+    # The state is column-major (byte 4 * col + row), ShiftRows moves row r left by r
+    _SHIFT_ROWS = np.array([4 * ((c + r) % 4) + r for c in range(4) for r in range(4)])
+    _INV_SHIFT_ROWS = np.array([4 * ((c - r) % 4) + r for c in range(4) for r in range(4)])
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("aes_numpy needs NumPy installed")
+
+
+def _round_keys(cipher, offset):
+    # Round key words of the cipher schedule as an (11, 16) byte array
+    words = np.array(cipher._schedule[offset:offset + 44], dtype=">u4")
+    return words.view(np.uint8).reshape(11, 16)
+
+
+def _mix_columns(state):
+    cols = state.reshape(-1, 4, 4)
+    a0 = cols[:, :, 0]
+    a1 = cols[:, :, 1]
+    a2 = cols[:, :, 2]
+    a3 = cols[:, :, 3]
+
+    out = np.empty_like(cols)
+    out[:, :, 0] = _G2[a0] ^ _G3[a1] ^ a2 ^ a3
+    out[:, :, 1] = a0 ^ _G2[a1] ^ _G3[a2] ^ a3
+    out[:, :, 2] = a0 ^ a1 ^ _G2[a2] ^ _G3[a3]
+    out[:, :, 3] = _G3[a0] ^ a1 ^ a2 ^ _G2[a3]
+    return out.reshape(-1, 16)
+
+
+def _inv_mix_columns(state):
+    cols = state.reshape(-1, 4, 4)
+    a0 = cols[:, :, 0]
+    a1 = cols[:, :, 1]
+    a2 = cols[:, :, 2]
+    a3 = cols[:, :, 3]
+
+    out = np.empty_like(cols)
+    out[:, :, 0] = _G14[a0] ^ _G11[a1] ^ _G13[a2] ^ _G9[a3]
+    out[:, :, 1] = _G9[a0] ^ _G14[a1] ^ _G11[a2] ^ _G13[a3]
+    out[:, :, 2] = _G13[a0] ^ _G9[a1] ^ _G14[a2] ^ _G11[a3]
+    out[:, :, 3] = _G11[a0] ^ _G13[a1] ^ _G9[a2] ^ _G14[a3]
+    return out.reshape(-1, 16)
+
+
+def encrypt_blocks(cipher, blocks):
+    # Same output as cipher.encrypt applied to every row of blocks
+    _require_numpy()
+    round_keys = _round_keys(cipher, 0)
+    state = np.asarray(blocks, dtype=np.uint8).reshape(-1, 16) ^ round_keys[0]
+
+    for r in range(1, 10):
+        state = _SBOX[state][:, _SHIFT_ROWS]
+        state = _mix_columns(state)
+        state ^= round_keys[r]
+
+    state = _SBOX[state][:, _SHIFT_ROWS]
+    state ^= round_keys[10]
+    return state
+
+
+def decrypt_blocks(cipher, blocks):
+    # Equivalent inverse cipher with the decryption half of the schedule
+    _require_numpy()
+    round_keys = _round_keys(cipher, 44)
+    state = np.asarray(blocks, dtype=np.uint8).reshape(-1, 16) ^ round_keys[0]
+
+    for r in range(1, 10):
+        state = _INV_SBOX[state][:, _INV_SHIFT_ROWS]
+        state = _inv_mix_columns(state)
+        state ^= round_keys[r]
+
+    state = _INV_SBOX[state][:, _INV_SHIFT_ROWS]
+    state ^= round_keys[10]
+    return state
+
+
+# ECB helpers with the same padding as AES_Encryption.encrypt_ecb / decrypt_ecb
+def encrypt_ecb(cipher, data):
+    _require_numpy()
+    padded = cipher._pad(data)
+    blocks = np.frombuffer(padded, dtype=np.uint8).reshape(-1, 16)
+    return encrypt_blocks(cipher, blocks).tobytes()
+
+
+def decrypt_ecb(cipher, data):
+    _require_numpy()
+    blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)
+    return cipher._unpad(decrypt_blocks(cipher, blocks).tobytes())
+
+
+def run_test():
+    import os
+    from aes_encryption import AES_Encryption
+
+    print("Running NumPy AES unit test")
+    if np is None:
+        print("NumPy is not installed, skipped")
+        return True
+
+    cipher = AES_Encryption(bytes.fromhex("000102030405060708090a0b0c0d0e0f"))
+    plaintext = bytes.fromhex("00112233445566778899aabbccddeeff")
+    ciphertext = bytes.fromhex("69c4e0d86a7b0430d8cdb78070b4c55a")
+    if encrypt_blocks(cipher, np.frombuffer(plaintext, dtype=np.uint8)).tobytes() != ciphertext:
+        print("Test failed in encryption mode")
+        return False
+    if decrypt_blocks(cipher, np.frombuffer(ciphertext, dtype=np.uint8)).tobytes() != plaintext:
+        print("Test failed in decryption mode")
+        return False
+
+    cipher = AES_Encryption(os.urandom(16))
+    data = os.urandom(1000)
+    encrypted = bytes(cipher.encrypt_ecb(data))
+    if encrypt_ecb(cipher, data) != encrypted or decrypt_ecb(cipher, encrypted) != data:
+        print("Test failed in ECB mode")
+        return False
+    print("Test OK")
+    return True
+
+
+if __name__ == "__main__":
+    run_test()
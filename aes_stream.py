@@ -0,0 +1,34 @@
+# Streaming AES-ECB with the same PKCS#7 padding as AES_Encryption.encrypt_ecb, the
+# block carrying and padding is done by streaming.BlockEncryptor / BlockDecryptor.
+
+import streaming
+
+# Bytes read per iteration by the file helpers
+CHUNK_SIZE = 64 * 1024
+
+
+class AES_StreamEncryptor(streaming.BlockEncryptor):
+    def __init__(self, cipher):
+        self.cipher = cipher
+        super().__init__(16, lambda data: _transform(cipher.encrypt_into, data), cipher._pad)
+
+
+class AES_StreamDecryptor(streaming.BlockDecryptor):
+    def __init__(self, cipher):
+        self.cipher = cipher
+        super().__init__(16, lambda data: _transform(cipher.decrypt_into, data), cipher._unpad)
+
+
+def _transform(into_function, data):
+    result = bytearray(len(data))
+    into_function(data, result)
+    return bytes(result)
+
+
+# File helpers, src and dst are binary file-like objects. Return the bytes written
+def encrypt_file(cipher, src, dst, chunk_size=CHUNK_SIZE):
+    return streaming.pump(AES_StreamEncryptor(cipher), src, dst, chunk_size)
+
+
+def decrypt_file(cipher, src, dst, chunk_size=CHUNK_SIZE):
+    return streaming.pump(AES_StreamDecryptor(cipher), src, dst, chunk_size)
@@ -0,0 +1,53 @@
+# Per-instance memory and construction time of AES_Encryption
+#
+# Run from the repository root:
+#   python -m benchmarks.aes_instances --count 20000
+
+import argparse
+import os
+import time
+import tracemalloc
+
+from aes_encryption import AES_Encryption
+
+
+def measure_construction(keys):
+    start = time.perf_counter()
+    for key in keys:
+        AES_Encryption(key)
+    return (time.perf_counter() - start) / len(keys)
+
+
+def measure_memory(keys):
+    # Warm up once so the shared tables are not counted against the instances
+    AES_Encryption(keys[0])
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    live = [AES_Encryption(key) for key in keys]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Subtract the list that keeps the instances alive
+    container = len(live) * 8
+    return (after - before - container) / len(keys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AES_Encryption per-instance cost")
+    parser.add_argument("--count", type=int, default=20000, help="number of live instances")
+    args = parser.parse_args(argv)
+
+    keys = [os.urandom(16) for _ in range(args.count)]
+
+    per_instance_time = measure_construction(keys)
+    per_instance_memory = measure_memory(keys)
+
+    print("instances:          %d" % args.count)
+    print("construction time:  %.1f us/instance" % (per_instance_time * 1e6))
+    print("resident memory:    %.0f bytes/instance" % per_instance_memory)
+    print("total for %d keys: %.2f MB" % (args.count, per_instance_memory * args.count / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Bitsliced AES against the table based AES_Encryption, ECB and CTR throughput
+#
+# Run from the repository root:
+#   python -m benchmarks.bitslice --size 1M --batch 256,1024,4096
+
+import argparse
+import os
+import time
+
+import aes_bitslice
+from aes_encryption import AES_Encryption
+from benchmarks.suite import format_size, parse_size
+
+
+def best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bitsliced AES against the table based path")
+    parser.add_argument("--size", default="1M", help="message size, e.g. 64K or 1M")
+    parser.add_argument("--batch", default="64,256,1024,4096", help="comma separated blocks per bitsliced batch")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs")
+    args = parser.parse_args(argv)
+
+    size = parse_size(args.size)
+    cipher = AES_Encryption(os.urandom(16))
+    data = os.urandom(size)
+    nonce = os.urandom(8)
+
+    def report(name, seconds):
+        print("%-28s %8.2f MB/s" % (name, size / seconds / 1e6))
+
+    print("message size: %s" % format_size(size))
+    report("table ecb.encrypt", best_time(lambda: cipher.encrypt_ecb(data), args.repeat))
+    report("table ctr", best_time(lambda: cipher.encrypt_ctr(data, nonce), args.repeat))
+    for batch in [int(b) for b in args.batch.split(",")]:
+        report("bitslice/%d ecb.encrypt" % batch,
+               best_time(lambda: aes_bitslice.encrypt_ecb(cipher, data, batch), args.repeat))
+        report("bitslice/%d ctr" % batch,
+               best_time(lambda: aes_bitslice.encrypt_ctr(cipher, data, nonce, 0, batch), args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Loopback echo benchmark for the asyncio Blowfish transport
+#
+# Run from the repository root:
+#   python -m benchmarks.blowfish_loopback --connections 50 --messages 20 --size 1K
+#
+# Every client sends its messages one at a time and waits for the echo, so the
+# latency of a message is a full encrypt, send, decrypt, re-encrypt, reply, decrypt
+# round trip. Throughput counts the payload bytes sent by all clients.
+
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import blowfish
+import blowfish_asyncio
+from benchmarks.suite import format_size, parse_size
+
+
+def echo_server(handlers):
+    # Echo handler that registers itself, so run() can wait for every connection to end
+    async def echo(reader, writer):
+        handlers.append(asyncio.current_task())
+        async for message in reader:
+            await writer.send(message)
+        writer.close()
+        await writer.wait_closed()
+
+    return echo
+
+
+async def client(port, cipher, messages, payload, latencies, options):
+    reader, writer = await blowfish_asyncio.open_connection("127.0.0.1", port, cipher, **options)
+    for _ in range(messages):
+        start = time.perf_counter()
+        await writer.send(payload)
+        reply = await reader.receive()
+        latencies.append(time.perf_counter() - start)
+        if reply != payload:
+            raise RuntimeError("echo mismatch")
+    writer.close()
+    await writer.wait_closed()
+
+
+async def run(args, executor):
+    cipher = blowfish.Blowfish(os.urandom(16))
+    options = {"executor": executor, "offload_threshold": args.threshold}
+    handlers = []
+    server = await blowfish_asyncio.start_server(echo_server(handlers), "127.0.0.1", 0, cipher, **options)
+    port = server.sockets[0].getsockname()[1]
+    payload = os.urandom(args.size)
+    latencies = []
+
+    start = time.perf_counter()
+    async with server:
+        await asyncio.gather(*(client(port, cipher, args.messages, payload, latencies, options)
+                               for _ in range(args.connections)))
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*handlers)
+        server.close()
+    return elapsed, sorted(latencies)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Blowfish asyncio transport over loopback")
+    parser.add_argument("--connections", type=int, default=50, help="concurrent client connections")
+    parser.add_argument("--messages", type=int, default=20, help="messages per connection")
+    parser.add_argument("--size", type=parse_size, default=parse_size("1K"), help="message size, e.g. 1K")
+    parser.add_argument("--threshold", type=parse_size, default=blowfish_asyncio.OFFLOAD_THRESHOLD,
+                        help="records above this size are handled on the executor")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="offload to a process pool of this size instead of the loop's threads")
+    args = parser.parse_args(argv)
+
+    executor = None
+    if args.processes:
+        # Start the workers before the event loop runs, forking them lazily from inside
+        # the loop can deadlock, and start-up time does not belong in the latencies
+        executor = ProcessPoolExecutor(args.processes)
+        list(executor.map(abs, range(args.processes)))
+    try:
+        elapsed, latencies = asyncio.run(run(args, executor))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    count = len(latencies)
+    print("connections:  %d x %d messages of %s" % (args.connections, args.messages, format_size(args.size)))
+    print("throughput:   %.3f MB/s" % (count * args.size / elapsed / 1e6))
+    print("messages:     %.1f round trips/s" % (count / elapsed))
+    print("latency p50:  %.2f ms" % (latencies[count // 2] * 1e3))
+    print("latency p99:  %.2f ms" % (latencies[min(count - 1, int(count * 0.99))] * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+# Cross-cipher benchmark suite with JSON baselines.
+#
+# Run from the repository root:
+#   python -m benchmarks.suite --save baseline.json
+#   python -m benchmarks.suite --compare baseline.json --threshold 0.1
+#
+# Every result is a named metric with a unit and a direction. When comparing, a metric
+# that got worse than the baseline by more than the threshold is reported as a
+# regression and the process exits with status 1. Metrics that are too noisy to gate
+# on, like the tail latencies of key generation, are only reported.
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import struct
+import sys
+import time
+
+import aes_encryption
+import blowfish
+import instrumentation
+import rsa_encryption
+
+DEFAULT_SIZES = "16,1K,64K,1M,64M"
+QUICK_SIZES = "16,1K,64K"
+DEFAULT_THRESHOLD = 0.10
+# Largest share of a single block operation the disabled instrumentation may cost,
+# measured against the same block operation without any instrumentation
+MAX_DISABLED_OVERHEAD = 0.01
+# Each measurement is the best of this many runs, which filters out most scheduler noise.
+# Runs that take longer than LONG_RUN seconds are not repeated, large sizes would take forever
+REPEAT = 5
+LONG_RUN = 2.0
+# Key generation samples, p90 is only reported from at least MIN_P90_SAMPLES of them so
+# that it is not just the largest sample again
+KEYGEN_RUNS = 20
+MIN_P90_SAMPLES = 20
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for suffix, factor in (("K", 1 << 10), ("M", 1 << 20), ("G", 1 << 30)):
+        if text.endswith(suffix):
+            return int(text[:-1]) * factor
+    return int(text)
+
+
+def format_size(size):
+    for suffix, factor in (("M", 1 << 20), ("K", 1 << 10)):
+        if size >= factor and size % factor == 0:
+            return "%d%s" % (size // factor, suffix)
+    return str(size)
+
+
+def time_per_call(fn, min_time):
+    # Call fn until min_time has passed (at least once), REPEAT times over, and
+    # return the best seconds per call
+    best = None
+    for _ in range(REPEAT):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / count < best:
+            best = elapsed / count
+        if elapsed >= LONG_RUN:
+            break
+    return best
+
+
+def result(name, value, unit, higher_is_better, gated=True, tolerance=0.0):
+    # Metrics that are not gated are compared and printed but never count as a regression,
+    # a tolerance above the threshold widens the allowed change for a noisy gated metric
+    return {"name": name, "value": value, "unit": unit, "higher_is_better": higher_is_better, "gated": gated,
+            "tolerance": tolerance}
+
+
+def throughput(name, fn, size, min_time):
+    seconds = time_per_call(fn, min_time)
+    return result(name, size / seconds / 1e6, "MB/s", True)
+
+
+# Benchmarks, each one returns a list of results
+
+def bench_aes(sizes, min_time):
+    cipher = aes_encryption.AES_Encryption(os.urandom(16))
+    results = []
+    for size in sizes:
+        data = os.urandom(size)
+        encrypted = bytes(cipher.encrypt_ecb(data))
+        label = format_size(size)
+        results.append(throughput("aes.ecb.encrypt.%s" % label, lambda: cipher.encrypt_ecb(data), size, min_time))
+        results.append(throughput("aes.ecb.decrypt.%s" % label, lambda: cipher.decrypt_ecb(encrypted), size, min_time))
+    return results
+
+
+def bench_blowfish(sizes, min_time):
+    cipher = blowfish.Blowfish(os.urandom(16))
+    results = []
+    for size in sizes:
+        data = os.urandom(size)
+        label = format_size(size)
+        ecb = cipher.encrypt_ecb(data)
+        cbc = cipher.encrypt_cbc(data)
+        results.append(throughput("blowfish.ecb.encrypt.%s" % label, lambda: cipher.encrypt_ecb(data), size, min_time))
+        results.append(throughput("blowfish.ecb.decrypt.%s" % label, lambda: cipher.decrypt_ecb(ecb), size, min_time))
+        results.append(throughput("blowfish.cbc.encrypt.%s" % label, lambda: cipher.encrypt_cbc(data), size, min_time))
+        results.append(throughput("blowfish.cbc.decrypt.%s" % label, lambda: cipher.decrypt_cbc(cbc), size, min_time))
+    return results
+
+
+def bench_key_setup(min_time):
+    aes_key = os.urandom(16)
+    blowfish_key = os.urandom(16)
+    return [
+        result("aes.key_setup", time_per_call(lambda: aes_encryption.AES_Encryption(aes_key), min_time) * 1e6,
+               "us", False),
+        result("blowfish.key_setup", time_per_call(lambda: blowfish.Blowfish(blowfish_key), min_time) * 1e6,
+               "us", False),
+    ]
+
+
+def bench_rsa(keygen_runs, min_time):
+    latencies = []
+    keys = None
+    for _ in range(keygen_runs):
+        start = time.perf_counter()
+        keys = rsa_encryption.generate_keys()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    median = statistics.median(latencies)
+
+    (e, n), private = keys
+    message = int.from_bytes(os.urandom(128), "big") % n
+    ciphertext = pow(message, e, n)
+
+    # Prime search latency is random, only the median is stable enough to gate on, and
+    # even that is allowed to move within its own confidence interval
+    results = [
+        result("rsa.keygen.min", latencies[0] * 1e3, "ms", False, gated=False),
+        result("rsa.keygen.median", median * 1e3, "ms", False, tolerance=_median_spread(latencies) / median),
+    ]
+    if len(latencies) >= MIN_P90_SAMPLES:
+        p90 = statistics.quantiles(latencies, n=10, method="inclusive")[-1]
+        results.append(result("rsa.keygen.p90", p90 * 1e3, "ms", False, gated=False))
+    return results + [
+        result("rsa.keygen.max", latencies[-1] * 1e3, "ms", False, gated=False),
+        result("rsa.encrypt", 1 / time_per_call(lambda: pow(message, e, n), min_time), "ops/s", True),
+        result("rsa.decrypt", 1 / time_per_call(lambda: private.decrypt(ciphertext), min_time), "ops/s", True),
+        result("rsa.decrypt.no_crt", 1 / time_per_call(lambda: pow(ciphertext, private.d, n), min_time), "ops/s", True),
+    ]
+
+
+def _median_spread(samples):
+    # Half the width of a ~95% confidence interval of the median of sorted samples,
+    # from the order statistics 0.98 * sqrt(n) ranks either side of the middle
+    k = int(0.98 * math.sqrt(len(samples)))
+    low = samples[max(0, (len(samples) - 1) // 2 - k)]
+    high = samples[min(len(samples) - 1, len(samples) // 2 + k)]
+    return (high - low) / 2
+
+
+def _bare_aes_encrypt(cipher, plain_text_bytes):
+    # AES_Encryption.encrypt without its instrumentation guards, keep the two in step
+    words = cipher._encrypt_words(*struct.unpack(">4I", plain_text_bytes))
+    return bytearray(struct.pack(">4I", *words))
+
+
+def _bare_blowfish_block(cipher, L, R):
+    # Blowfish.encrypt_block without its instrumentation guard, keep the two in step
+    s0, s1, s2, s3 = cipher.s
+    return blowfish.encipher(L, R, cipher.p, s0, s1, s2, s3)
+
+
+def _relative_times(functions, min_time, rounds=60):
+    # Median over short rounds of each function's time relative to functions[0], minus
+    # one. Every round times all of them with the order rotated, so neither drift in
+    # clock speed or load nor running first or last favours one of them
+    calls = max(1, int(min_time / rounds / time_per_call(functions[0], min_time / rounds)))
+    n = len(functions)
+    ratios = [[] for _ in range(n)]
+    for r in range(rounds):
+        times = [0.0] * n
+        for k in range(n):
+            i = (k + r) % n
+            f = functions[i]
+            start = time.perf_counter()
+            for _ in range(calls):
+                f()
+            times[i] = time.perf_counter() - start
+        for i in range(n):
+            ratios[i].append(times[i] / times[0] - 1)
+    return [statistics.median(r) for r in ratios]
+
+
+def _disabled_overhead(name, instrumented, bare, min_time):
+    # The instrumented call against the bare one, plus the bare call against a second
+    # copy of itself: the guards cost less than the run to run noise of a single block,
+    # so the noise is reported next to the overhead and the check allows for it
+    _, overhead, noise = _relative_times([bare, instrumented, lambda: bare()], min_time)
+    return [
+        result("instrumentation.disabled_overhead." + name, overhead * 100, "%", False),
+        result("instrumentation.noise." + name, abs(noise) * 100, "%", False),
+    ]
+
+
+def bench_instrumentation(min_time):
+    # Real instrumented call sites with instrumentation disabled, against the same work
+    # without any guard: AES_Encryption.encrypt against the same unpack, _encrypt_words
+    # and pack, Blowfish.encrypt_block against the same blowfish.encipher call. One block
+    # is the cheapest instrumented call, so this is the largest relative cost the guards
+    # can have
+    instrumentation.disable()
+
+    aes = aes_encryption.AES_Encryption(os.urandom(16))
+    block = os.urandom(16)
+    results = _disabled_overhead("aes", lambda: aes.encrypt(block), lambda: _bare_aes_encrypt(aes, block), min_time)
+
+    bf = blowfish.Blowfish(os.urandom(16))
+    L, R = struct.unpack(">2I", os.urandom(8))
+    results += _disabled_overhead("blowfish", lambda: bf.encrypt_block(L, R), lambda: _bare_blowfish_block(bf, L, R),
+                                  min_time)
+
+    disabled = time_per_call(lambda: aes.encrypt(block), min_time)
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        enabled = time_per_call(lambda: aes.encrypt(block), min_time)
+    finally:
+        instrumentation.disable()
+        instrumentation.reset()
+
+    results.append(result("instrumentation.enabled_overhead", (enabled - disabled) / disabled * 100, "%", False))
+    return results
+
+
+def check_instrumentation(results, limit):
+    # Fails when a disabled overhead is above the limit by more than its measured noise
+    values = {r["name"]: r["value"] for r in results}
+    ok = True
+    for name, value in values.items():
+        if name.startswith("instrumentation.disabled_overhead."):
+            noise = values.get(name.replace("disabled_overhead", "noise"), 0.0)
+            within = value <= limit * 100 + noise
+            print("%s %.3f%% (limit %.1f%%, noise %.3f%%): %s"
+                  % (name, value, limit * 100, noise, "ok" if within else "FAILED"))
+            ok = ok and within
+    return ok
+
+
+def run(args):
+    sizes = [parse_size(s) for s in (QUICK_SIZES if args.quick else args.sizes).split(",")]
+    groups = args.only.split(",") if args.only else ["aes", "blowfish", "keysetup", "rsa", "instrumentation"]
+
+    results = []
+    if "aes" in groups:
+        results += bench_aes(sizes, args.min_time)
+    if "blowfish" in groups:
+        results += bench_blowfish(sizes, args.min_time)
+    if "keysetup" in groups:
+        results += bench_key_setup(args.min_time)
+    if "rsa" in groups:
+        results += bench_rsa(args.keygen_runs, args.min_time)
+    if "instrumentation" in groups:
+        results += bench_instrumentation(args.min_time)
+    return results
+
+
+# Baselines
+
+def save_baseline(path, results):
+    document = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2)
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+
+    regressions = []
+    for r in results:
+        old = baseline.get(r["name"])
+        # Instrumentation overheads are fractions of a percent around zero, a relative
+        # change means nothing there, check_instrumentation holds them to a limit instead
+        if old is None or old["value"] == 0 or r["name"].startswith("instrumentation."):
+            continue
+        change = (r["value"] - old["value"]) / old["value"]
+        # Positive change means better in both directions
+        if not r["higher_is_better"]:
+            change = -change
+        allowed = max(threshold, r.get("tolerance", 0.0), old.get("tolerance", 0.0))
+        status = "ok" if r.get("gated", True) else "info"
+        if change < -allowed and status == "ok":
+            status = "REGRESSION"
+            regressions.append(r["name"])
+        print("%-32s %12.3f -> %12.3f %-6s %+7.1f%%  %s"
+              % (r["name"], old["value"], r["value"], r["unit"], change * 100, status))
+    return regressions
+
+
+def print_results(results):
+    for r in results:
+        print("%-32s %12.3f %s" % (r["name"], r["value"], r["unit"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark AES, Blowfish and RSA")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated message sizes, e.g. 16,1K,1M")
+    parser.add_argument("--quick", action="store_true", help="only small message sizes (%s)" % QUICK_SIZES)
+    parser.add_argument("--only", help="comma separated groups: aes,blowfish,keysetup,rsa,instrumentation")
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds per run, every measurement takes %d runs" % REPEAT)
+    parser.add_argument("--keygen-runs", type=int, default=KEYGEN_RUNS,
+                        help="RSA generate_keys samples, p90 needs at least %d" % MIN_P90_SAMPLES)
+    parser.add_argument("--save", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="compare against a JSON baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed relative slowdown before a metric counts as a regression")
+    parser.add_argument("--max-disabled-overhead", type=float, default=MAX_DISABLED_OVERHEAD,
+                        help="fail if disabled instrumentation costs more than this share of an AES or Blowfish block")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+    else:
+        print_results(results)
+        regressions = []
+
+    if args.save:
+        save_baseline(args.save, results)
+
+    failed = not check_instrumentation(results, args.max_disabled_overhead)
+
+    if regressions:
+        print("%d regression(s) above %.0f%%: %s" % (len(regressions), args.threshold * 100, ", ".join(regressions)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
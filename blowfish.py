@@ -1,15 +1,32 @@
 import os
+import sys
+from array import array
 
-#Import the base tables for blowfish start
-from blowfish_base_tables import p_array, s0, s1, s2, s3
+import counter_mode
+import instrumentation
+import parallel
+
+# Bytes per worker job when CBC decryption runs on a pool
+CBC_CHUNK_SIZE = 1 << 20
+
+# The base tables are imported inside build_parray / expand_key, so importing this
+# module stays cheap until a key is actually expanded
 
 def pad(data):
+	start = instrumentation.now() if instrumentation.enabled else None
 	pad_len = 8 - (len(data) % 8)
-	return data + bytes([pad_len] * pad_len)
+	padded = data + bytes([pad_len] * pad_len)
+	if start is not None:
+		instrumentation.record("blowfish.padding", 1, instrumentation.elapsed(start))
+	return padded
 
 def unpad(data):
+	start = instrumentation.now() if instrumentation.enabled else None
 	pad_len = data[-1]
-	return data[:-pad_len]
+	unpadded = data[:-pad_len]
+	if start is not None:
+		instrumentation.record("blowfish.padding", 1, instrumentation.elapsed(start))
+	return unpadded
 
 def get_input():
 	text = input("Plase insert the text you want to cryptograph: ").encode()
@@ -23,6 +40,8 @@ def get_input():
 
 
 def build_parray(key):
+	from blowfish_base_tables import p_array
+
 	p = p_array.copy()
 	k_index = 0
 	for i in range(18):
@@ -32,7 +51,289 @@ def build_parray(key):
 			k_index = (k_index + 1) % len(key)
 		p[i] ^= data
 	return p
-	
+
+
+def _expand(key):
+	# Key schedule, returns the P-array and the four S-boxes as fresh lists
+	from blowfish_base_tables import s0, s1, s2, s3
+
+	s = [s0.copy(), s1.copy(), s2.copy(), s3.copy()]
+	p = build_parray(key)
+	s_0, s_1, s_2, s_3 = s
+
+	L = 0x00000000
+	R = 0x00000000
+	for j in range(0, 18 + 4 * 256, 2):
+		L, R = encipher(L, R, p, s_0, s_1, s_2, s_3)
+
+		# Every output pair replaces the next two entries of P, then S0 to S3
+		if j < 18:
+			p[j] = L
+			p[j + 1] = R
+		else:
+			box = s[(j - 18) >> 8]
+			box[(j - 18) & 0xFF] = L
+			box[(j - 18 + 1) & 0xFF] = R
+	return p, s
+
+
+class Blowfish:
+	# Owns its P-array and S-boxes as tuples, nothing is written after __init__ so one
+	# instance can be shared between threads and pickled to worker processes
+	__slots__ = ("p", "s")
+
+	def __init__(self, key):
+		if not 4 <= len(key) <= 56:
+			raise ValueError("key must be 4 to 56 bytes long")
+		start = instrumentation.now() if instrumentation.enabled else None
+		p, s = _expand(key)
+		self.p = tuple(p)
+		self.s = tuple(tuple(box) for box in s)
+		if start is not None:
+			instrumentation.record("blowfish.key_setup", 1, instrumentation.elapsed(start))
+
+	@classmethod
+	def from_schedule(cls, p_array, s_boxes):
+		# Rebuild a cipher from an already expanded P-array and S-boxes
+		if len(p_array) != 18 or len(s_boxes) != 4 or any(len(box) != 256 for box in s_boxes):
+			raise ValueError("expected 18 P-array entries and four 256 entry S-boxes")
+		self = cls.__new__(cls)
+		self.p = tuple(p_array)
+		self.s = tuple(tuple(box) for box in s_boxes)
+		return self
+
+	# Expanded schedule as 18 + 4 * 256 big-endian 32-bit words, P-array first
+	SCHEDULE_SIZE = 4 * (18 + 4 * 256)
+
+	def schedule_bytes(self):
+		words = array("I", self.p)
+		for box in self.s:
+			words.extend(box)
+		return _from_words(words)
+
+	@classmethod
+	def from_schedule_bytes(cls, data):
+		if len(data) != cls.SCHEDULE_SIZE:
+			raise ValueError("schedule must be %d bytes long" % cls.SCHEDULE_SIZE)
+		words = _to_words(data)
+		return cls.from_schedule(words[:18], [words[18 + 256 * i:18 + 256 * (i + 1)] for i in range(4)])
+
+	def encrypt_block(self, L, R):
+		if instrumentation.enabled:
+			instrumentation.record("blowfish.encrypt_block")
+		s0, s1, s2, s3 = self.s
+		return encipher(L, R, self.p, s0, s1, s2, s3)
+
+	def decrypt_block(self, L, R):
+		if instrumentation.enabled:
+			instrumentation.record("blowfish.decrypt_block")
+		s0, s1, s2, s3 = self.s
+		return encipher(L, R, self.p[::-1], s0, s1, s2, s3)
+
+	# ECB
+
+	def encrypt_ecb(self, data):
+		start = instrumentation.now() if instrumentation.enabled else None
+		data = pad(data)
+		ciphertext = _from_words(_encipher_words(_to_words(data), self.p, self.s))
+		if start is not None:
+			instrumentation.record("blowfish.ecb.encrypt", len(data) // 8, instrumentation.elapsed(start))
+		return ciphertext
+
+	def decrypt_ecb(self, data):
+		start = instrumentation.now() if instrumentation.enabled else None
+		plaintext = unpad(_from_words(_encipher_words(_to_words(data), self.p[::-1], self.s)))
+		if start is not None:
+			instrumentation.record("blowfish.ecb.decrypt", len(data) // 8, instrumentation.elapsed(start))
+		return plaintext
+
+	# CBC, the random IV is prepended to the ciphertext
+
+	def encrypt_cbc(self, data):
+		start = instrumentation.now() if instrumentation.enabled else None
+		data = pad(data)
+		iv = os.urandom(8)
+		ciphertext = iv + self._encrypt_cbc_raw(data, iv)
+		if start is not None:
+			instrumentation.record("blowfish.cbc.encrypt", len(data) // 8, instrumentation.elapsed(start))
+		return ciphertext
+
+	def decrypt_cbc(self, data, executor=None, chunk_size=CBC_CHUNK_SIZE):
+		# Every plaintext block only needs its own and the previous ciphertext block, so
+		# with an executor the chunks are decrypted in parallel, each worker getting the
+		# ciphertext block in front of its chunk as IV
+		start = instrumentation.now() if instrumentation.enabled else None
+		iv = data[:8]
+		ciphertext = data[8:]
+		if executor is None or len(ciphertext) <= chunk_size:
+			plaintext = self._decrypt_cbc_raw(ciphertext, iv)
+		else:
+			if len(ciphertext) % 8:
+				raise ValueError("data length must be a multiple of 8")
+			jobs = []
+			for chunk_start, chunk_end in parallel.split_range(len(ciphertext), chunk_size, 8):
+				chunk_iv = bytes(data[chunk_start:chunk_start + 8])
+				jobs.append((self, chunk_iv, chunk_start, chunk_end))
+			plaintext = parallel.run_shared(executor, ciphertext, _cbc_decrypt_worker, jobs)
+		plaintext = unpad(plaintext)
+		if start is not None:
+			instrumentation.record("blowfish.cbc.decrypt", len(ciphertext) // 8, instrumentation.elapsed(start))
+		return plaintext
+
+	def _encrypt_cbc_raw(self, data, iv):
+		return _from_words(_encipher_words(_to_words(data), self.p, self.s, _to_words(iv)))
+
+	def _decrypt_cbc_raw(self, ciphertext, iv):
+		# Blocks decrypt independently, the chaining is one XOR with the ciphertext
+		# shifted by a block (IV first) over the whole message
+		decrypted = _from_words(_encipher_words(_to_words(ciphertext), self.p[::-1], self.s))
+		if not decrypted:
+			return decrypted
+		chain = bytes(iv) + bytes(ciphertext[:-8])
+		return (int.from_bytes(decrypted, "big") ^ int.from_bytes(chain, "big")).to_bytes(len(decrypted), "big")
+
+
+	# CTR with the counter block layout of counter_mode
+
+	def encrypt_ctr(self, data, nonce, initial_counter=0):
+		start = instrumentation.now() if instrumentation.enabled else None
+		n_blocks = (len(data) + 7) // 8
+		keystream = self._ctr_keystream(nonce, initial_counter, n_blocks)[:len(data)]
+		result = _xor_bytes(data, keystream)
+		if start is not None:
+			instrumentation.record("blowfish.ctr", n_blocks, instrumentation.elapsed(start))
+		return result
+
+	def decrypt_ctr(self, data, nonce, initial_counter=0):
+		return self.encrypt_ctr(data, nonce, initial_counter)
+
+	def _ctr_keystream(self, nonce, counter, n_blocks):
+		prefix, _ = counter_mode.counter_space(nonce, 8, counter, n_blocks)
+
+		counters = array("I")
+		for i in range(n_blocks):
+			block = prefix | (counter + i)
+			counters.append(block >> 32)
+			counters.append(block & 0xFFFFFFFF)
+		return _from_words(_encipher_words(counters, self.p, self.s))
+
+	# OFB, the keystream is the IV encrypted over and over
+
+	def encrypt_ofb(self, data, iv):
+		start = instrumentation.now() if instrumentation.enabled else None
+		n_blocks = (len(data) + 7) // 8
+		keystream = self._ofb_keystream(iv, n_blocks)[:len(data)]
+		result = _xor_bytes(data, keystream)
+		if start is not None:
+			instrumentation.record("blowfish.ofb", n_blocks, instrumentation.elapsed(start))
+		return result
+
+	def decrypt_ofb(self, data, iv):
+		return self.encrypt_ofb(data, iv)
+
+	def _ofb_keystream(self, iv, n_blocks):
+		# CBC over zero blocks gives exactly E(iv), E(E(iv)), ... The last 8 bytes are
+		# the IV that continues the stream
+		if len(iv) != 8:
+			raise ValueError("iv must be 8 bytes long")
+		return _from_words(_encipher_words(array("I", bytes(8 * n_blocks)), self.p, self.s, _to_words(iv)))
+
+# Bulk engine. Messages are converted to big-endian 32-bit words once, run through
+# the unrolled rounds and written into one preallocated array
+
+_SWAP = sys.byteorder == "little"
+
+def _to_words(data):
+	if len(data) % 8:
+		raise ValueError("data length must be a multiple of 8")
+	words = array("I")
+	words.frombytes(data)
+	if _SWAP:
+		words.byteswap()
+	return words
+
+def _from_words(words):
+	if _SWAP:
+		words.byteswap()
+	return words.tobytes()
+
+def _xor_bytes(data, keystream):
+	return (int.from_bytes(data, "big") ^ int.from_bytes(keystream, "big")).to_bytes(len(data), "big")
+
+def encipher(L, R, p, s0, s1, s2, s3):
+	# One block through the 16 unrolled rounds, the only copy of the round function
+	# every Python engine in the project uses. Decryption is the same with p reversed
+	p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, p17 = p
+	L ^= p0
+	R ^= ((s0[L >> 24] + s1[(L >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(L >> 8) & 0xFF]) + s3[L & 0xFF] & 0xFFFFFFFF
+	R ^= p1
+	L ^= ((s0[R >> 24] + s1[(R >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(R >> 8) & 0xFF]) + s3[R & 0xFF] & 0xFFFFFFFF
+	L ^= p2
+	R ^= ((s0[L >> 24] + s1[(L >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(L >> 8) & 0xFF]) + s3[L & 0xFF] & 0xFFFFFFFF
+	R ^= p3
+	L ^= ((s0[R >> 24] + s1[(R >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(R >> 8) & 0xFF]) + s3[R & 0xFF] & 0xFFFFFFFF
+	L ^= p4
+	R ^= ((s0[L >> 24] + s1[(L >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(L >> 8) & 0xFF]) + s3[L & 0xFF] & 0xFFFFFFFF
+	R ^= p5
+	L ^= ((s0[R >> 24] + s1[(R >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(R >> 8) & 0xFF]) + s3[R & 0xFF] & 0xFFFFFFFF
+	L ^= p6
+	R ^= ((s0[L >> 24] + s1[(L >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(L >> 8) & 0xFF]) + s3[L & 0xFF] & 0xFFFFFFFF
+	R ^= p7
+	L ^= ((s0[R >> 24] + s1[(R >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(R >> 8) & 0xFF]) + s3[R & 0xFF] & 0xFFFFFFFF
+	L ^= p8
+	R ^= ((s0[L >> 24] + s1[(L >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(L >> 8) & 0xFF]) + s3[L & 0xFF] & 0xFFFFFFFF
+	R ^= p9
+	L ^= ((s0[R >> 24] + s1[(R >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(R >> 8) & 0xFF]) + s3[R & 0xFF] & 0xFFFFFFFF
+	L ^= p10
+	R ^= ((s0[L >> 24] + s1[(L >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(L >> 8) & 0xFF]) + s3[L & 0xFF] & 0xFFFFFFFF
+	R ^= p11
+	L ^= ((s0[R >> 24] + s1[(R >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(R >> 8) & 0xFF]) + s3[R & 0xFF] & 0xFFFFFFFF
+	L ^= p12
+	R ^= ((s0[L >> 24] + s1[(L >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(L >> 8) & 0xFF]) + s3[L & 0xFF] & 0xFFFFFFFF
+	R ^= p13
+	L ^= ((s0[R >> 24] + s1[(R >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(R >> 8) & 0xFF]) + s3[R & 0xFF] & 0xFFFFFFFF
+	L ^= p14
+	R ^= ((s0[L >> 24] + s1[(L >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(L >> 8) & 0xFF]) + s3[L & 0xFF] & 0xFFFFFFFF
+	R ^= p15
+	L ^= ((s0[R >> 24] + s1[(R >> 16) & 0xFF]) & 0xFFFFFFFF ^ s2[(R >> 8) & 0xFF]) + s3[R & 0xFF] & 0xFFFFFFFF
+	return R ^ p17, L ^ p16
+
+def _encipher_words(words, p, s, iv=None):
+	# Encrypts every (L, R) word pair, decryption is the same with p reversed.
+	# With an IV the pairs are CBC chained
+	s0, s1, s2, s3 = s
+	out = array("I", bytes(len(words) * 4))
+	chain = iv is not None
+	L = R = 0
+	if chain:
+		L, R = iv
+	for j in range(0, len(words), 2):
+		if chain:
+			L ^= words[j]
+			R ^= words[j + 1]
+		else:
+			L = words[j]
+			R = words[j + 1]
+		L, R = encipher(L, R, p, s0, s1, s2, s3)
+		out[j] = L
+		out[j + 1] = R
+	return out
+
+
+def _cbc_decrypt_worker(shm_name, cipher, iv, start, end):
+	shm = parallel.attach_shared(shm_name)
+	try:
+		shm.buf[start:end] = cipher._decrypt_cbc_raw(bytes(shm.buf[start:end]), iv)
+	finally:
+		shm.close()
+
+
+# Module level API kept for existing callers. expand_key stores the S-boxes of the last
+# expanded key in the global s and returns its P-array, the functions below always use
+# that global, so only one key can be active at a time. New code should use Blowfish
+
+def _legacy_cipher(p_array):
+	return Blowfish.from_schedule(p_array, s)
 
 def f(x):
 	a = (x >> 24) & 0xFF
@@ -47,6 +348,8 @@ def f(x):
 	return y
 
 def encrypt_block(L, R, p_array):
+	if instrumentation.enabled:
+		instrumentation.record("blowfish.encrypt_block")
 	for i in range(16):
 		L ^= p_array[i]
 		R ^= f(L)
@@ -58,6 +361,8 @@ def encrypt_block(L, R, p_array):
 	return L & 0xFFFFFFFF, R & 0xFFFFFFFF
 
 def decrypt_block(L, R, p_array):
+	if instrumentation.enabled:
+		instrumentation.record("blowfish.decrypt_block")
 	for i in range(17,1,-1):
 		L ^= p_array[i]
 		R ^= f(L)
@@ -72,115 +377,26 @@ def decrypt_block(L, R, p_array):
 def expand_key(key):
 	global s
 
-	s = [s0.copy(), s1.copy(), s2.copy(), s3.copy()]
-
-	p = build_parray(key)
-
-	L = 0x00000000
-	R = 0x00000000
-
-	#Update P array
-	for i in range(0,18,2):
-		L, R = encrypt_block(L, R, p)
-		p[i] = L
-		p[i+1] = R
-
-	#Update S boxes
-	for box in range(4):
-		for i in range(0, 256, 2):
-			L, R = encrypt_block(L, R, p)
-			s[box][i] = L
-			s[box][i+1] = R
+	start = instrumentation.now() if instrumentation.enabled else None
+	p, s = _expand(key)
+	if start is not None:
+		instrumentation.record("blowfish.key_setup", 1, instrumentation.elapsed(start))
 	return p
 
-# ECB Crypto start
-
 def encrypt_ecb(data, p_array):
-	data = pad(data)
-	ciphertext = b""
-
-	for i in range(0, len(data), 8):
-		block = data[i: i+8]
-		L = int.from_bytes(block[:4], "big")
-		R = int.from_bytes(block[4:], "big")
-
-		L, R = encrypt_block(L, R, p_array)
-
-		ciphertext += L.to_bytes(4, "big")
-		ciphertext += R.to_bytes(4, "big")
-	return ciphertext
+	return _legacy_cipher(p_array).encrypt_ecb(data)
 
 def decrypt_ecb(data, p_array):
-	plaintext = b""
-
-	for i in range(0, len(data), 8):
-		block = data[i: i+8]
-		L = int.from_bytes(block[:4], "big")
-		R = int.from_bytes(block[4:], "big")
-
-		L, R = decrypt_block(L, R, p_array)
-
-		plaintext += L.to_bytes(4, "big")
-		plaintext += R.to_bytes(4, "big")
-	
-	print(plaintext)
-
-	return unpad(plaintext)
-
-#ECB Crypto end
-
-#CBC Crypto start
+	return _legacy_cipher(p_array).decrypt_ecb(data)
 
 def encrypt_cbc(data, p_array):
-	data = pad(data)
-	iv = os.urandom(8)
-	ciphertext = iv
-	prev_block = iv
-
-	for i in range(0, len(data), 8):
-		block = data[i:i+8]
-		xored = bytes(a ^ b for a, b in zip(block, prev_block))
-
-		L = int.from_bytes(xored[:4], "big")
-		R = int.from_bytes(xored[4:], "big")
-
-		L, R =  encrypt_block(L, R, p_array)
-
-		encrypted_block = L.to_bytes(4, "big") + R.to_bytes(4, "big")
-		ciphertext += encrypted_block
-		prev_block = encrypted_block
-
-	return ciphertext
+	return _legacy_cipher(p_array).encrypt_cbc(data)
 
 def _decrypt_cbc_raw(ciphertext, p_array, iv):
-
-    plaintext = b""
-    prev_block = iv
-
-    for i in range(0, len(ciphertext), 8):
-        block = ciphertext[i:i+8]
-
-        L = int.from_bytes(block[:4], "big")
-        R = int.from_bytes(block[4:], "big")
-
-        L, R = decrypt_block(L, R, p_array)
-
-        decrypted_block = L.to_bytes(4, "big") + R.to_bytes(4, "big")
-
-        plain_block = bytes(a ^ b for a, b in zip(decrypted_block, prev_block))
-
-        plaintext += plain_block
-        prev_block = block
-
-    return plaintext
+	return _legacy_cipher(p_array)._decrypt_cbc_raw(ciphertext, iv)
 
 def decrypt_cbc(data, p_array):
-	iv = data[:8]
-	ciphertext = data[8:]
-	plaintext = _decrypt_cbc_raw(ciphertext, p_array, iv)
-	return unpad(plaintext)
-
-#CBC Crypto end
+	return _legacy_cipher(p_array).decrypt_cbc(data)
 
 #Testing
 #CBC Encryption Unit Test
@@ -192,19 +408,29 @@ def run_test():
 	plaintext = bytes.fromhex("37363534333231204E6F772069732074")
 	expected_cipher = bytes.fromhex("6B77B4D63006DEE605B156E274039793")
 
-	p_final = expand_key(key)
-	cipher = test_encrypt_cbc(plaintext, p_final, iv)
-	cipher_without_iv = cipher[8:]
+	cipher = Blowfish(key)
+	cipher_without_iv = cipher._encrypt_cbc_raw(plaintext, iv)
 
 	if expected_cipher != cipher_without_iv:
 		print("Test failed in encryption mode")
-	else:
-		expected_decrypt = _decrypt_cbc_raw(cipher_without_iv, p_final, iv)
-
-		if expected_decrypt == plaintext:
-			print("Test OK")
-		else:
-			print("Test failed in decryption mode")
+		return False
+	if cipher._decrypt_cbc_raw(cipher_without_iv, iv) != plaintext:
+		print("Test failed in decryption mode")
+		return False
+
+	# Pool path of decrypt_cbc, small chunks so every worker gets several blocks and the
+	# IVs taken from in front of each chunk are exercised
+	from concurrent.futures import ProcessPoolExecutor
+
+	data = os.urandom(1001)
+	encrypted = cipher.encrypt_cbc(data)
+	with ProcessPoolExecutor(2) as pool:
+		decrypted = cipher.decrypt_cbc(encrypted, pool, chunk_size=64)
+	if decrypted != cipher.decrypt_cbc(encrypted) or decrypted != data:
+		print("Test failed in parallel CBC decryption")
+		return False
+	print("Test OK")
+	return True
 
 
 def test_encrypt_cbc(data, p_array, temp_iv):
@@ -228,13 +454,15 @@ def test_encrypt_cbc(data, p_array, temp_iv):
 
 	return ciphertext
 
-run_test()
 
-key, text = get_input()
-p_final = expand_key(key)
-cipher = encrypt_cbc(text, p_final)
-dec = decrypt_cbc(cipher, p_final)
+if __name__ == "__main__":
+	run_test()
+
+	key, text = get_input()
+	blowfish = Blowfish(key)
+	cipher = blowfish.encrypt_cbc(text)
+	dec = blowfish.decrypt_cbc(cipher)
 
-print("Original:", text.decode())
-print("Encrypted:", cipher.hex())
-print("Decrypted:", dec.decode())
+	print("Original:", text.decode())
+	print("Encrypted:", cipher.hex())
+	print("Decrypted:", dec.decode())
@@ -0,0 +1,108 @@
+# asyncio stream wrappers that exchange Blowfish-CBC encrypted records.
+#
+#   reader, writer = await blowfish_asyncio.open_connection(host, port, cipher)
+#   await writer.send(b"hello")
+#   reply = await reader.receive()
+#
+# Every message travels as one record: a 4-byte big-endian length followed by the
+# message in Blowfish.encrypt_cbc format (8-byte IV, then the padded ciphertext), so
+# legacy peers only need to strip the length prefix. Records larger than
+# offload_threshold are encrypted or decrypted on an executor so the event loop keeps
+# serving other connections. The default executor is the loop's thread pool, pass a
+# ProcessPoolExecutor to spread the cipher work over several cores (start its workers
+# before the event loop runs, see benchmarks/blowfish_loopback.py).
+
+import asyncio
+import struct
+
+import instrumentation
+
+# Records up to this size are handled inline on the event loop
+OFFLOAD_THRESHOLD = 16 * 1024
+# Largest record a reader accepts, protects against a hostile length prefix
+MAX_RECORD_SIZE = 16 * 1024 * 1024
+
+_HEADER = struct.Struct(">I")
+
+
+async def _run(function, data, executor, offload_threshold):
+	if len(data) <= offload_threshold:
+		return function(data)
+	if instrumentation.enabled:
+		instrumentation.record("blowfish_asyncio.offload")
+	return await asyncio.get_running_loop().run_in_executor(executor, function, data)
+
+
+class BlowfishStreamWriter:
+	def __init__(self, writer, cipher, executor=None, offload_threshold=OFFLOAD_THRESHOLD):
+		self.writer = writer
+		self.cipher = cipher
+		self.executor = executor
+		self.offload_threshold = offload_threshold
+
+	async def send(self, message):
+		record = await _run(self.cipher.encrypt_cbc, bytes(message), self.executor, self.offload_threshold)
+		self.writer.write(_HEADER.pack(len(record)))
+		self.writer.write(record)
+		await self.writer.drain()
+
+	def close(self):
+		self.writer.close()
+
+	async def wait_closed(self):
+		await self.writer.wait_closed()
+
+
+class BlowfishStreamReader:
+	def __init__(self, reader, cipher, executor=None, offload_threshold=OFFLOAD_THRESHOLD,
+			max_record_size=MAX_RECORD_SIZE):
+		self.reader = reader
+		self.cipher = cipher
+		self.executor = executor
+		self.offload_threshold = offload_threshold
+		self.max_record_size = max_record_size
+
+	async def receive(self):
+		# The next decrypted message, or None when the peer closed between records
+		try:
+			header = await self.reader.readexactly(_HEADER.size)
+		except asyncio.IncompleteReadError as e:
+			if e.partial:
+				raise ValueError("connection closed inside a record header")
+			return None
+		(length,) = _HEADER.unpack(header)
+		if length < 16 or length % 8 or length > self.max_record_size:
+			raise ValueError("invalid record length %d" % length)
+		try:
+			record = await self.reader.readexactly(length)
+		except asyncio.IncompleteReadError:
+			raise ValueError("connection closed inside a record")
+		return await _run(self.cipher.decrypt_cbc, record, self.executor, self.offload_threshold)
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		message = await self.receive()
+		if message is None:
+			raise StopAsyncIteration
+		return message
+
+
+def wrap(reader, writer, cipher, executor=None, offload_threshold=OFFLOAD_THRESHOLD):
+	return (BlowfishStreamReader(reader, cipher, executor, offload_threshold),
+			BlowfishStreamWriter(writer, cipher, executor, offload_threshold))
+
+
+async def open_connection(host, port, cipher, executor=None, offload_threshold=OFFLOAD_THRESHOLD, **kwargs):
+	reader, writer = await asyncio.open_connection(host, port, **kwargs)
+	return wrap(reader, writer, cipher, executor, offload_threshold)
+
+
+async def start_server(client_connected_cb, host, port, cipher, executor=None,
+		offload_threshold=OFFLOAD_THRESHOLD, **kwargs):
+	# client_connected_cb(reader, writer) gets the wrapped streams
+	async def handle(reader, writer):
+		await client_connected_cb(*wrap(reader, writer, cipher, executor, offload_threshold))
+
+	return await asyncio.start_server(handle, host, port, **kwargs)
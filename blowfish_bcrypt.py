@@ -0,0 +1,225 @@
+# bcrypt password hashing on top of the Blowfish key schedule (EksBlowfish).
+#
+#   hashed = blowfish_bcrypt.hashpw("correct horse", cost=12)
+#   blowfish_bcrypt.checkpw("correct horse", hashed)        # True
+#   cost = blowfish_bcrypt.calibrate(0.25)                   # cost for ~250 ms here
+#   blowfish_bcrypt.verify_many([(password, hashed), ...], executor)
+#
+# Hashes use the standard "$2b$<cost>$<22 char salt><31 char hash>" encoding, $2a$ and
+# $2y$ hashes are accepted by checkpw as well.
+
+import base64
+import hmac
+import math
+import os
+import time
+
+import instrumentation
+from blowfish import encipher
+
+DEFAULT_COST = 10
+MIN_COST = 4
+MAX_COST = 31
+SALT_SIZE = 16
+# bcrypt only looks at the first 72 bytes of the password (including the NUL terminator)
+MAX_PASSWORD_SIZE = 72
+
+_PREFIXES = ("2a", "2b", "2y")
+_MAGIC = b"OrpheanBeholderScryDoubt"
+_STD_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+_BCRYPT_ALPHABET = b"./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+_TO_BCRYPT = bytes.maketrans(_STD_ALPHABET, _BCRYPT_ALPHABET)
+_FROM_BCRYPT = bytes.maketrans(_BCRYPT_ALPHABET, _STD_ALPHABET)
+
+
+def _b64_encode(data):
+	return base64.b64encode(data).translate(_TO_BCRYPT).rstrip(b"=").decode("ascii")
+
+
+def _b64_decode(text):
+	# b64decode would skip characters outside the alphabet, reject them instead
+	data = text.encode("ascii")
+	if data.translate(None, _BCRYPT_ALPHABET):
+		raise ValueError("invalid character in bcrypt base64")
+	data = data.translate(_FROM_BCRYPT)
+	return base64.b64decode(data + b"=" * (-len(data) % 4), validate=True)
+
+
+def _stream_words(data, count):
+	# count big-endian words from data repeated cyclically, like build_parray does
+	words = []
+	index = 0
+	for _ in range(count):
+		word = 0
+		for _ in range(4):
+			word = (word << 8) | data[index]
+			index = (index + 1) % len(data)
+		words.append(word)
+	return words
+
+
+def _expand(p, s, key_words, salt_words=None):
+	# ExpandKey from the bcrypt paper: XOR the key into P, then refill P and the S-boxes
+	# with the running encryption, each block first XORed with the next two salt words
+	s0, s1, s2, s3 = s
+	for i in range(18):
+		p[i] ^= key_words[i]
+
+	L = R = 0
+	k = 0
+	for i in range(0, 18, 2):
+		if salt_words:
+			L ^= salt_words[k]
+			R ^= salt_words[k + 1]
+			k ^= 2
+		L, R = encipher(L, R, p, s0, s1, s2, s3)
+		p[i] = L
+		p[i + 1] = R
+
+	for box in s:
+		for i in range(0, 256, 2):
+			if salt_words:
+				L ^= salt_words[k]
+				R ^= salt_words[k + 1]
+				k ^= 2
+			L, R = encipher(L, R, p, s0, s1, s2, s3)
+			box[i] = L
+			box[i + 1] = R
+
+
+def _eks_blowfish(cost, salt, key):
+	from blowfish_base_tables import p_array, s0, s1, s2, s3
+
+	p = p_array.copy()
+	s = [s0.copy(), s1.copy(), s2.copy(), s3.copy()]
+	key_words = _stream_words(key, 18)
+	salt_words = _stream_words(salt, 4)
+	salt_key_words = _stream_words(salt, 18)
+
+	_expand(p, s, key_words, salt_words)
+	for _ in range(1 << cost):
+		_expand(p, s, key_words)
+		_expand(p, s, salt_key_words)
+	return p, s
+
+
+def _raw_hash(password, salt, cost):
+	start = instrumentation.now() if instrumentation.enabled else None
+	if isinstance(password, str):
+		password = password.encode("utf-8")
+	key = (bytes(password) + b"\0")[:MAX_PASSWORD_SIZE]
+
+	p, s = _eks_blowfish(cost, salt, key)
+	s0, s1, s2, s3 = s
+	words = _stream_words(_MAGIC, 6)
+	for _ in range(64):
+		for i in range(0, 6, 2):
+			words[i], words[i + 1] = encipher(words[i], words[i + 1], p, s0, s1, s2, s3)
+
+	digest = b"".join(word.to_bytes(4, "big") for word in words)
+	if start is not None:
+		instrumentation.record("bcrypt.hash", 1, instrumentation.elapsed(start))
+	# The encoding drops the last byte of the 24-byte digest
+	return digest[:23]
+
+
+def _parse(hashed):
+	if isinstance(hashed, bytes):
+		hashed = hashed.decode("ascii")
+	parts = hashed.split("$")
+	if len(parts) != 4 or parts[0] or parts[1] not in _PREFIXES or len(parts[3]) != 53:
+		raise ValueError("not a bcrypt hash")
+	if len(parts[2]) != 2 or not (parts[2].isascii() and parts[2].isdigit()) or not MIN_COST <= int(parts[2]) <= MAX_COST:
+		raise ValueError("invalid bcrypt cost")
+	# The hash part is compared as text, but it has to be valid bcrypt base64 as well
+	salt = _b64_decode(parts[3][:22])
+	_b64_decode(parts[3][22:])
+	if len(salt) != SALT_SIZE:
+		raise ValueError("invalid bcrypt salt")
+	return parts[1], int(parts[2]), salt, parts[3][22:]
+
+
+def hashpw(password, cost=DEFAULT_COST, salt=None):
+	if not MIN_COST <= cost <= MAX_COST:
+		raise ValueError("cost must be between %d and %d" % (MIN_COST, MAX_COST))
+	if salt is None:
+		salt = os.urandom(SALT_SIZE)
+	if len(salt) != SALT_SIZE:
+		raise ValueError("salt must be %d bytes long" % SALT_SIZE)
+	return "$2b$%02d$%s%s" % (cost, _b64_encode(salt), _b64_encode(_raw_hash(password, salt, cost)))
+
+
+def checkpw(password, hashed):
+	prefix, cost, salt, expected = _parse(hashed)
+	computed = _b64_encode(_raw_hash(password, salt, cost))
+	return hmac.compare_digest(computed, expected)
+
+
+# Cost calibration
+
+def calibrate(target_seconds=0.25, min_cost=MIN_COST, max_cost=MAX_COST):
+	# Highest cost whose hash should take at most target_seconds on this machine. Every
+	# cost step doubles the work, so one measurement at min_cost is extrapolated
+	start = time.perf_counter()
+	_raw_hash(b"calibration", bytes(SALT_SIZE), min_cost)
+	measured = time.perf_counter() - start
+	if measured >= target_seconds:
+		return min_cost
+	cost = min_cost + int(math.floor(math.log2(target_seconds / measured)))
+	return min(cost, max_cost)
+
+
+# Batch verification
+
+def _check_pair(pair):
+	password, hashed = pair
+	try:
+		return checkpw(password, hashed)
+	except ValueError:
+		return False
+
+
+def verify_many(pairs, executor=None, max_workers=None):
+	# checkpw for every (password, hashed) pair in order, malformed hashes give False.
+	# Without an executor a process pool is created for the call
+	pairs = list(pairs)
+	if executor is not None:
+		return list(executor.map(_check_pair, pairs))
+
+	from concurrent.futures import ProcessPoolExecutor
+
+	with ProcessPoolExecutor(max_workers) as pool:
+		return list(pool.map(_check_pair, pairs))
+
+
+# Known answer test from the OpenBSD bcrypt test vectors
+def run_test():
+	print("Running bcrypt unit test")
+	hashed = "$2a$05$CCCCCCCCCCCCCCCCCCCCC.E5YPO9kmyuRGyh0XouQYb4YMJKvyOeW"
+	if not checkpw("U*U", hashed):
+		print("Test failed in verification")
+		return False
+	if checkpw("U*V", hashed):
+		print("Test failed, wrong password accepted")
+		return False
+	salt = _b64_decode("CCCCCCCCCCCCCCCCCCCCC.")
+	if hashpw("U*U", 5, salt) != "$2b" + hashed[3:]:
+		print("Test failed in hashing")
+		return False
+
+	# Malformed hashes raise ValueError (False from verify_many), never anything else
+	body = hashed[7:]
+	for malformed in ("$2b$04$" + "!" * 22 + "a" * 31, "$2b$05$" + body[:10] + "!" + body[11:],
+			"$2b$05$" + body[:-1] + "+", "$2b$5$" + body + "a", "$2b$+5$" + body, "$2b$05$" + "\xe9" * 53):
+		try:
+			checkpw("U*U", malformed)
+		except ValueError:
+			continue
+		print("Test failed, malformed hash %r accepted" % malformed)
+		return False
+	print("Test OK")
+	return True
+
+
+if __name__ == "__main__":
+	run_test()
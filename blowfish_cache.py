@@ -0,0 +1,276 @@
+# Cache of expanded Blowfish key schedules, in memory and optionally on disk.
+#
+#   store = blowfish_cache.ScheduleStore("schedules.bin", master_key)
+#   cache = blowfish_cache.ScheduleCache(max_size=1024, store=store)
+#   cipher = cache.get(key)        # memory, then disk, then a full key expansion
+#
+# Entries are keyed by a keyed BLAKE2 digest of the Blowfish key, never by the key
+# itself. The store is an append-only file of fixed size records, each one the digest,
+# a nonce, the serialized schedule and a tag. Records are encrypt-then-MAC with keys
+# derived from the master key: the keystream is keyed BLAKE2b over nonce and block
+# number, the tag a keyed BLAKE2b over digest, nonce and ciphertext. hashlib runs that
+# at C speed, where AES-GCM in Python would cost as much as expanding the key again.
+# The file is read through mmap, so a worker can open it and only decrypt the
+# schedules it actually needs.
+
+import hashlib
+import hmac
+import mmap
+import os
+import threading
+
+import instrumentation
+import lru
+from blowfish import Blowfish
+
+DEFAULT_MAX_SIZE = 1024
+
+_MAGIC = b"BFKS\x01\x00\x00\x00"
+_DIGEST_SIZE = 16
+_NONCE_SIZE = 16
+_TAG_SIZE = 16
+RECORD_SIZE = _DIGEST_SIZE + _NONCE_SIZE + Blowfish.SCHEDULE_SIZE + _TAG_SIZE
+
+
+def _derive(master_key, label):
+	return hashlib.blake2b(label, key=bytes(master_key), digest_size=32).digest()
+
+
+def _keystream(key, nonce, length):
+	blocks = [hashlib.blake2b(nonce + i.to_bytes(8, "big"), key=key).digest() for i in range((length + 63) // 64)]
+	return b"".join(blocks)[:length]
+
+
+def _xor(data, keystream):
+	return (int.from_bytes(data, "big") ^ int.from_bytes(keystream, "big")).to_bytes(len(data), "big")
+
+
+def _tag(key, digest, nonce, ciphertext):
+	return hashlib.blake2b(digest + nonce + ciphertext, key=key, digest_size=_TAG_SIZE).digest()
+
+
+class ScheduleStore:
+	def __init__(self, path, master_key, writable=True):
+		if not 16 <= len(master_key) <= 64:
+			raise ValueError("master key must be 16 to 64 bytes long")
+		self.path = path
+		self.writable = writable
+		self._encryption_key = _derive(master_key, b"blowfish schedule encryption")
+		self._mac_key = _derive(master_key, b"blowfish schedule authentication")
+		self._index_key = _derive(master_key, b"blowfish schedule index")
+		self._lock = threading.Lock()
+		self._index = {}
+		self._map = None
+		self._size = 0
+
+		if writable and not os.path.exists(path):
+			with open(path, "wb") as f:
+				f.write(_MAGIC)
+		self._remap()
+
+	def digest(self, key):
+		# Stable across processes sharing the master key, so the index can live on disk
+		return hashlib.blake2b(bytes(key), key=self._index_key, digest_size=_DIGEST_SIZE).digest()
+
+	def _remap(self):
+		# (Re)open the mapping and index every complete record past the old end
+		with open(self.path, "rb") as f:
+			size = os.fstat(f.fileno()).st_size
+			if size < len(_MAGIC):
+				raise ValueError("%s is not a schedule store" % self.path)
+			mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+		if mapped[:len(_MAGIC)] != _MAGIC:
+			mapped.close()
+			raise ValueError("%s is not a schedule store" % self.path)
+
+		if self._map is not None:
+			self._map.close()
+		self._map = mapped
+		offset = max(self._size, len(_MAGIC))
+		while offset + RECORD_SIZE <= size:
+			self._index[bytes(mapped[offset:offset + _DIGEST_SIZE])] = offset
+			offset += RECORD_SIZE
+		self._size = offset
+
+	def load(self, digest):
+		# The cipher stored under digest, or None. Records that fail authentication
+		# (wrong master key, corruption) are treated as missing
+		with self._lock:
+			offset = self._index.get(digest)
+			if offset is None:
+				return None
+			record = self._map[offset:offset + RECORD_SIZE]
+		nonce = record[_DIGEST_SIZE:_DIGEST_SIZE + _NONCE_SIZE]
+		ciphertext = record[_DIGEST_SIZE + _NONCE_SIZE:-_TAG_SIZE]
+		if not hmac.compare_digest(record[-_TAG_SIZE:], _tag(self._mac_key, digest, nonce, ciphertext)):
+			return None
+		schedule = _xor(ciphertext, _keystream(self._encryption_key, nonce, len(ciphertext)))
+		return Blowfish.from_schedule_bytes(schedule)
+
+	def save(self, digest, cipher):
+		if not self.writable:
+			raise ValueError("store is read-only")
+		nonce = os.urandom(_NONCE_SIZE)
+		schedule = cipher.schedule_bytes()
+		ciphertext = _xor(schedule, _keystream(self._encryption_key, nonce, len(schedule)))
+		record = digest + nonce + ciphertext + _tag(self._mac_key, digest, nonce, ciphertext)
+		with self._lock:
+			if digest in self._index:
+				return
+			# One write() on an append-only descriptor, readers index complete records only
+			fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+			try:
+				os.write(fd, record)
+			finally:
+				os.close(fd)
+			self._remap()
+
+	def refresh(self):
+		# Pick up records appended by other processes
+		with self._lock:
+			self._remap()
+
+	def digests(self):
+		with self._lock:
+			return list(self._index)
+
+	def __len__(self):
+		return len(self._index)
+
+	def close(self):
+		with self._lock:
+			if self._map is not None:
+				self._map.close()
+				self._map = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+class ScheduleCache(lru.LRUCache):
+	def __init__(self, max_size=DEFAULT_MAX_SIZE, store=None):
+		super().__init__(max_size)
+		self.store = store
+		self._salt = os.urandom(16)
+		self.disk_hits = 0
+		self.misses = 0
+
+	def _digest(self, key):
+		if self.store is not None:
+			return self.store.digest(key)
+		return hashlib.blake2b(bytes(key), key=self._salt, digest_size=_DIGEST_SIZE).digest()
+
+	def _insert(self, digest, cipher):
+		evicted = super()._insert(digest, cipher)
+		if evicted and instrumentation.enabled:
+			instrumentation.record("blowfish_cache.eviction", evicted)
+		return evicted
+
+	def get(self, key):
+		digest = self._digest(key)
+		cipher = self._lookup(digest)
+		if cipher is not None:
+			if instrumentation.enabled:
+				instrumentation.record("blowfish_cache.hit")
+			return cipher
+
+		cipher = self.store.load(digest) if self.store is not None else None
+		if cipher is not None:
+			with self._lock:
+				self.disk_hits += 1
+			if instrumentation.enabled:
+				instrumentation.record("blowfish_cache.disk_hit")
+		else:
+			cipher = Blowfish(key)
+			with self._lock:
+				self.misses += 1
+			if instrumentation.enabled:
+				instrumentation.record("blowfish_cache.miss")
+			if self.store is not None and self.store.writable:
+				self.store.save(digest, cipher)
+
+		self._insert(digest, cipher)
+		return cipher
+
+	def warm(self, limit=None):
+		# Preload up to limit (default max_size) schedules from the store, returns how many
+		limit = self.max_size if limit is None else min(limit, self.max_size)
+		if self.store is None or limit <= 0:
+			return 0
+		loaded = 0
+		for digest in self.store.digests()[-limit:]:
+			cipher = self.store.load(digest)
+			if cipher is not None:
+				self._insert(digest, cipher)
+				loaded += 1
+		return loaded
+
+	def stats(self):
+		stats = super().stats()
+		with self._lock:
+			stats["disk_hits"] = self.disk_hits
+			stats["misses"] = self.misses
+		return stats
+
+
+def run_test():
+	import tempfile
+
+	print("Running Blowfish schedule cache unit test")
+	master_key = os.urandom(32)
+	keys = [os.urandom(16) for _ in range(6)]
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, "schedules.bin")
+		with ScheduleStore(path, master_key) as store:
+			cache = ScheduleCache(max_size=4, store=store)
+			for key in keys:
+				cache.get(key)
+			digests = [store.digest(key) for key in keys]
+
+		# A fresh store on the same file decrypts what the first one wrote
+		with ScheduleStore(path, master_key, writable=False) as store:
+			for key, digest in zip(keys, digests):
+				cipher = store.load(digest)
+				if cipher is None or cipher.schedule_bytes() != Blowfish(key).schedule_bytes():
+					print("Test failed, schedule did not survive a reload")
+					return False
+
+			cache = ScheduleCache(max_size=4, store=store)
+			if cache.warm(0) != 0 or len(cache) != 0:
+				print("Test failed, warm(0) loaded schedules")
+				return False
+			if cache.warm(2) != 2 or cache.warm() != 4 or len(cache) != 4:
+				print("Test failed in warm")
+				return False
+			cache.get(keys[-1])
+			if cache.stats()["hits"] != 1:
+				print("Test failed, warm did not load the newest schedules")
+				return False
+
+		# The records are found by digest but fail authentication under another master key
+		with ScheduleStore(path, os.urandom(32), writable=False) as store:
+			if store.load(digests[0]) is not None:
+				print("Test failed, wrong master key was accepted")
+				return False
+
+		with open(path, "r+b") as f:
+			f.seek(len(_MAGIC) + RECORD_SIZE // 2)
+			byte = f.read(1)
+			f.seek(-1, os.SEEK_CUR)
+			f.write(bytes([byte[0] ^ 1]))
+		with ScheduleStore(path, master_key, writable=False) as store:
+			if store.load(digests[0]) is not None:
+				print("Test failed, corrupt record was accepted")
+				return False
+			if store.load(digests[1]) is None:
+				print("Test failed, intact record was rejected")
+				return False
+	print("Test OK")
+	return True
+
+
+if __name__ == "__main__":
+	run_test()
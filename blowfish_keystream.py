@@ -0,0 +1,214 @@
+# Blowfish CTR and OFB keystream generated ahead of time on a background thread.
+#
+#   stream = blowfish_keystream.ctr_keystream(cipher, nonce)
+#   ciphertext = stream.xor(message)      # only an XOR when the buffer is warm
+#   ...
+#   stream.close()
+#
+# A producer thread keeps a ring buffer of keystream topped up while the caller is idle,
+# xor() only copies keystream out of it. The stream is continuous: consecutive calls
+# use consecutive keystream bytes, so the receiver has to consume its own stream (same
+# key, nonce or IV) in the same order, or use Blowfish.decrypt_ctr / decrypt_ofb with
+# the byte offset in `position`. A stream that is dropped without close() stops its
+# thread when it is garbage collected.
+
+import threading
+import weakref
+
+import counter_mode
+import instrumentation
+
+# Keystream bytes kept ready, and how much the producer generates per step
+DEFAULT_CAPACITY = 64 * 1024
+REFILL_SIZE = 4 * 1024
+
+
+def _ctr_chunks(cipher, nonce, counter, counter_bits, chunk_blocks):
+	# The last chunk stops at the end of the counter field, asking for more raises
+	end = 1 << counter_bits
+	while True:
+		blocks = min(chunk_blocks, end - counter)
+		if blocks <= 0:
+			raise ValueError("CTR counter space is exhausted")
+		yield cipher._ctr_keystream(nonce, counter, blocks)
+		counter += blocks
+
+
+def _ofb_chunks(cipher, iv, chunk_blocks):
+	while True:
+		chunk = cipher._ofb_keystream(iv, chunk_blocks)
+		iv = chunk[-8:]
+		yield chunk
+
+
+class _State:
+	# Everything the producer thread touches. The thread holds only this, never the
+	# KeystreamBuffer, so a buffer nobody closed can still be collected, and its
+	# finalizer then stops the thread
+	def __init__(self, chunks, capacity, refill):
+		self.chunks = chunks
+		self.ring = bytearray(capacity)
+		self.capacity = capacity
+		self.refill = refill
+		self.head = 0
+		self.size = 0
+		self.closed = False
+		self.error = None
+		self.cond = threading.Condition()
+
+
+def _produce(state):
+	try:
+		while True:
+			with state.cond:
+				while not state.closed and state.capacity - state.size < state.refill:
+					state.cond.wait()
+				if state.closed:
+					return
+			# The cipher runs outside the lock, xor() can drain the buffer meanwhile
+			chunk = next(state.chunks)
+			with state.cond:
+				tail = (state.head + state.size) % state.capacity
+				first = min(len(chunk), state.capacity - tail)
+				state.ring[tail:tail + first] = chunk[:first]
+				state.ring[:len(chunk) - first] = chunk[first:]
+				state.size += len(chunk)
+				state.cond.notify_all()
+	except Exception as e:
+		with state.cond:
+			state.error = e
+			state.cond.notify_all()
+
+
+def _shutdown(state):
+	with state.cond:
+		state.closed = True
+		state.cond.notify_all()
+
+
+class KeystreamBuffer:
+	def __init__(self, chunks, capacity=DEFAULT_CAPACITY, refill=REFILL_SIZE):
+		# chunks is an iterator of keystream pieces of `refill` bytes each
+		if capacity < refill:
+			raise ValueError("capacity must be at least the refill size")
+		self._state = _State(chunks, capacity, refill)
+		self.position = 0
+		self.stalls = 0
+		self._thread = threading.Thread(target=_produce, args=(self._state,), name="blowfish-keystream", daemon=True)
+		self._thread.start()
+		self._finalizer = weakref.finalize(self, _shutdown, self._state)
+
+	def take(self, n):
+		# The next n keystream bytes, waits for the producer when the buffer runs dry
+		state = self._state
+		out = bytearray(n)
+		got = 0
+		with state.cond:
+			while got < n:
+				if state.size == 0:
+					self.stalls += 1
+					if instrumentation.enabled:
+						instrumentation.record("blowfish.keystream.stall")
+					# The producer may be waiting for the room this call just made
+					state.cond.notify_all()
+					while state.size == 0 and not state.closed and state.error is None:
+						state.cond.wait()
+					if state.error is not None:
+						raise state.error
+					if state.closed:
+						raise ValueError("keystream is closed")
+				count = min(n - got, state.size, state.capacity - state.head)
+				out[got:got + count] = state.ring[state.head:state.head + count]
+				state.head = (state.head + count) % state.capacity
+				state.size -= count
+				got += count
+			self.position += n
+			state.cond.notify_all()
+		return bytes(out)
+
+	def xor(self, data):
+		# Encrypts or decrypts data with the next len(data) keystream bytes
+		if not data:
+			return b""
+		keystream = self.take(len(data))
+		return (int.from_bytes(data, "big") ^ int.from_bytes(keystream, "big")).to_bytes(len(data), "big")
+
+	def available(self):
+		with self._state.cond:
+			return self._state.size
+
+	def close(self):
+		self._finalizer()
+		self._thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def ctr_keystream(cipher, nonce, initial_counter=0, capacity=DEFAULT_CAPACITY, refill=REFILL_SIZE):
+	# Same keystream as cipher.encrypt_ctr(data, nonce, initial_counter)
+	# At least the first block has to fit
+	_, counter_bits = counter_mode.counter_space(nonce, 8, initial_counter, 1)
+	if refill % 8:
+		raise ValueError("refill must be a multiple of 8")
+	return KeystreamBuffer(_ctr_chunks(cipher, nonce, initial_counter, counter_bits, refill // 8), capacity, refill)
+
+
+def ofb_keystream(cipher, iv, capacity=DEFAULT_CAPACITY, refill=REFILL_SIZE):
+	# Same keystream as cipher.encrypt_ofb(data, iv)
+	if len(iv) != 8:
+		raise ValueError("iv must be 8 bytes long")
+	if refill % 8:
+		raise ValueError("refill must be a multiple of 8")
+	return KeystreamBuffer(_ofb_chunks(cipher, bytes(iv), refill // 8), capacity, refill)
+
+
+# Requests longer than the buffer, the producer has to refill it while take() waits
+def run_test():
+	import gc
+	import os
+
+	from blowfish import Blowfish
+
+	print("Running Blowfish keystream unit test")
+	cipher = Blowfish(os.urandom(16))
+	nonce = os.urandom(4)
+	iv = os.urandom(8)
+	data = os.urandom(5000)
+
+	with ctr_keystream(cipher, nonce, capacity=1024, refill=256) as stream:
+		# 5000 bytes are 625 blocks, the second call continues at counter 625
+		first = stream.xor(data)
+		second = stream.xor(data[:100])
+		if first != cipher.encrypt_ctr(data, nonce) or second != cipher.encrypt_ctr(data[:100], nonce, 625):
+			print("Test failed in CTR mode")
+			return False
+	with ofb_keystream(cipher, iv, capacity=1024, refill=256) as stream:
+		if stream.xor(data) != cipher.encrypt_ofb(data, iv):
+			print("Test failed in OFB mode")
+			return False
+
+	data = os.urandom(DEFAULT_CAPACITY + 4000)
+	with ctr_keystream(cipher, nonce) as stream:
+		if stream.xor(data) != cipher.encrypt_ctr(data, nonce):
+			print("Test failed with the default capacity")
+			return False
+
+	# A stream that is never closed stops its producer once it is collected
+	stream = ctr_keystream(cipher, nonce, capacity=1024, refill=256)
+	thread = stream._thread
+	del stream
+	gc.collect()
+	thread.join(5)
+	if thread.is_alive():
+		print("Test failed, producer thread outlived its stream")
+		return False
+	print("Test OK")
+	return True
+
+
+if __name__ == "__main__":
+	run_test()
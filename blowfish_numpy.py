@@ -0,0 +1,131 @@
+# Batched Blowfish over many 64-bit blocks, the L and R halves of all blocks are uint32
+# arrays and F gathers from the four S-boxes for every block at once. uint32 addition
+# wraps by itself, so the results are bit-identical to Blowfish.encrypt_block.
+# NumPy is optional, the rest of the project does not need it.
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+import counter_mode
+
+
+def _require_numpy():
+	if np is None:
+		raise RuntimeError("blowfish_numpy needs NumPy installed")
+
+
+def _tables(cipher):
+	return [np.array(box, dtype=np.uint32) for box in cipher.s]
+
+
+def _encipher(L, R, p, s):
+	# 16 rounds over the halves, p reversed gives decryption
+	s0, s1, s2, s3 = s
+	p = [np.uint32(x) for x in p]
+	for i in range(16):
+		L = L ^ p[i]
+		R = R ^ (((s0[L >> 24] + s1[(L >> 16) & 0xFF]) ^ s2[(L >> 8) & 0xFF]) + s3[L & 0xFF])
+		L, R = R, L
+	return R ^ p[17], L ^ p[16]
+
+
+def _crypt_blocks(cipher, blocks, p):
+	words = np.frombuffer(np.ascontiguousarray(blocks, dtype=np.uint8).tobytes(), dtype=">u4").astype(np.uint32)
+	L, R = _encipher(words[0::2], words[1::2], p, _tables(cipher))
+	out = np.empty(len(words), dtype=">u4")
+	out[0::2] = L
+	out[1::2] = R
+	return out.view(np.uint8).reshape(-1, 8)
+
+
+def encrypt_blocks(cipher, blocks):
+	# Same output as cipher.encrypt_block applied to every row of an (N, 8) byte array
+	_require_numpy()
+	return _crypt_blocks(cipher, blocks, cipher.p)
+
+
+def decrypt_blocks(cipher, blocks):
+	_require_numpy()
+	return _crypt_blocks(cipher, blocks, cipher.p[::-1])
+
+
+# ECB helpers with the same padding as Blowfish.encrypt_ecb / decrypt_ecb
+def encrypt_ecb(cipher, data):
+	import blowfish
+
+	_require_numpy()
+	return encrypt_blocks(cipher, np.frombuffer(blowfish.pad(data), dtype=np.uint8)).tobytes()
+
+
+def decrypt_ecb(cipher, data):
+	import blowfish
+
+	_require_numpy()
+	if len(data) % 8:
+		raise ValueError("data length must be a multiple of 8")
+	return blowfish.unpad(decrypt_blocks(cipher, np.frombuffer(data, dtype=np.uint8)).tobytes())
+
+
+# CTR with the same counter block layout as Blowfish.encrypt_ctr
+def encrypt_ctr(cipher, data, nonce, initial_counter=0):
+	_require_numpy()
+	n_blocks = (len(data) + 7) // 8
+	prefix, _ = counter_mode.counter_space(nonce, 8, initial_counter, n_blocks)
+	prefix = np.uint64(prefix)
+
+	counters = (np.arange(n_blocks, dtype=np.uint64) + np.uint64(initial_counter)) | prefix
+	L, R = _encipher((counters >> np.uint64(32)).astype(np.uint32), (counters & np.uint64(0xFFFFFFFF)).astype(np.uint32),
+		cipher.p, _tables(cipher))
+
+	keystream = np.empty(2 * n_blocks, dtype=">u4")
+	keystream[0::2] = L
+	keystream[1::2] = R
+	keystream = keystream.view(np.uint8)[:len(data)]
+	return (np.frombuffer(data, dtype=np.uint8) ^ keystream).tobytes()
+
+
+def decrypt_ctr(cipher, data, nonce, initial_counter=0):
+	return encrypt_ctr(cipher, data, nonce, initial_counter)
+
+
+def run_test():
+	import os
+	import struct
+	from blowfish import Blowfish
+
+	print("Running NumPy Blowfish unit test")
+	if np is None:
+		print("NumPy is not installed, skipped")
+		return True
+
+	cipher = Blowfish(os.urandom(16))
+	blocks = os.urandom(8 * 64)
+	encrypted = encrypt_blocks(cipher, np.frombuffer(blocks, dtype=np.uint8)).tobytes()
+	decrypted = decrypt_blocks(cipher, np.frombuffer(blocks, dtype=np.uint8)).tobytes()
+	for i in range(0, len(blocks), 8):
+		L, R = struct.unpack(">2I", blocks[i:i + 8])
+		if encrypted[i:i + 8] != struct.pack(">2I", *cipher.encrypt_block(L, R)):
+			print("Test failed in encryption mode")
+			return False
+		if decrypted[i:i + 8] != struct.pack(">2I", *cipher.decrypt_block(L, R)):
+			print("Test failed in decryption mode")
+			return False
+
+	data = os.urandom(1001)
+	nonce = os.urandom(4)
+	ecb = cipher.encrypt_ecb(data)
+	if encrypt_ecb(cipher, data) != ecb or decrypt_ecb(cipher, ecb) != data:
+		print("Test failed in ECB mode")
+		return False
+	ctr = cipher.encrypt_ctr(data, nonce, 5)
+	if encrypt_ctr(cipher, data, nonce, 5) != ctr or decrypt_ctr(cipher, ctr, nonce, 5) != data:
+		print("Test failed in CTR mode")
+		return False
+	print("Test OK")
+	return True
+
+
+if __name__ == "__main__":
+	run_test()
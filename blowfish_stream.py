@@ -0,0 +1,101 @@
+# Streaming Blowfish-CBC in the same format as Blowfish.encrypt_cbc: the 8-byte IV,
+# then the PKCS#7 padded ciphertext. The block carrying and padding is done by
+# streaming.BlockEncryptor / BlockDecryptor, these classes add the IV and the chaining.
+
+import os
+
+import blowfish
+import streaming
+
+# Bytes read per iteration by the file helpers
+CHUNK_SIZE = 64 * 1024
+
+
+class Blowfish_StreamEncryptor(streaming.BlockEncryptor):
+	def __init__(self, cipher, iv=None):
+		self.cipher = cipher
+		self._iv = os.urandom(8) if iv is None else bytes(iv)
+		if len(self._iv) != 8:
+			raise ValueError("iv must be 8 bytes long")
+		self._header = self._iv
+		super().__init__(8, self._encrypt, blowfish.pad)
+
+	def _encrypt(self, data):
+		# The IV goes out in front of the first output
+		out = self._header
+		self._header = b""
+		if data:
+			encrypted = self.cipher._encrypt_cbc_raw(data, self._iv)
+			self._iv = encrypted[-8:]
+			out += encrypted
+		return out
+
+
+class Blowfish_StreamDecryptor(streaming.BlockDecryptor):
+	def __init__(self, cipher):
+		self.cipher = cipher
+		self._iv = None
+		self._header = b""
+		super().__init__(8, self._decrypt, blowfish.unpad)
+
+	def update(self, chunk):
+		# The IV comes first, everything after it is ciphertext
+		if self._iv is None:
+			data = self._header + bytes(chunk)
+			if len(data) < 8:
+				self._header = data
+				return b""
+			self._iv = data[:8]
+			chunk = data[8:]
+		return super().update(chunk)
+
+	def _decrypt(self, ciphertext):
+		if not ciphertext:
+			return b""
+		plaintext = self.cipher._decrypt_cbc_raw(ciphertext, self._iv)
+		self._iv = ciphertext[-8:]
+		return plaintext
+
+
+# File helpers, src and dst are binary file-like objects. Return the bytes written
+def encrypt_file(cipher, src, dst, chunk_size=CHUNK_SIZE):
+	return streaming.pump(Blowfish_StreamEncryptor(cipher), src, dst, chunk_size)
+
+
+def decrypt_file(cipher, src, dst, chunk_size=CHUNK_SIZE):
+	return streaming.pump(Blowfish_StreamDecryptor(cipher), src, dst, chunk_size)
+
+
+def run_test():
+	import io
+
+	print("Running streaming Blowfish unit test")
+	cipher = blowfish.Blowfish(os.urandom(16))
+	for length in (0, 1, 7, 8, 9, 63, 64, 100):
+		data = os.urandom(length)
+		for chunk_size in (1, 7, 9):
+			# Same bytes as encrypt_cbc with the same IV, the IV first
+			stream = Blowfish_StreamEncryptor(cipher, b"\x01" * 8)
+			out = b"".join(stream.update(data[i:i + chunk_size]) for i in range(0, length, chunk_size))
+			out += stream.finalize()
+			if out != b"\x01" * 8 + cipher._encrypt_cbc_raw(blowfish.pad(data), b"\x01" * 8):
+				print("Test failed in encryption mode")
+				return False
+
+			encrypted = io.BytesIO()
+			encrypt_file(cipher, io.BytesIO(data), encrypted, chunk_size)
+			if cipher.decrypt_cbc(encrypted.getvalue()) != data:
+				print("Test failed, decrypt_cbc cannot read the stream")
+				return False
+
+			decrypted = io.BytesIO()
+			decrypt_file(cipher, io.BytesIO(cipher.encrypt_cbc(data)), decrypted, chunk_size)
+			if decrypted.getvalue() != data:
+				print("Test failed, the stream cannot read encrypt_cbc")
+				return False
+	print("Test OK")
+	return True
+
+
+if __name__ == "__main__":
+	run_test()
@@ -0,0 +1,14 @@
+# Counter block layout shared by every CTR mode in the project: the nonce followed by
+# a big-endian counter filling the rest of the cipher block. A counter that would run
+# past that field raises instead of wrapping, a wrapped counter repeats the keystream.
+
+
+def counter_space(nonce, block_size, initial_counter, n_blocks):
+    # Checks that n_blocks counters from initial_counter fit next to the nonce and
+    # returns (prefix, counter_bits), the counter block of counter i is prefix | i
+    if len(nonce) >= block_size:
+        raise ValueError("nonce must be shorter than %d bytes" % block_size)
+    counter_bits = 8 * (block_size - len(nonce))
+    if initial_counter < 0 or initial_counter + n_blocks > 1 << counter_bits:
+        raise ValueError("counter does not fit in the %d bits left by the nonce" % counter_bits)
+    return int.from_bytes(nonce, "big") << counter_bits, counter_bits
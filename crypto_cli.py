@@ -0,0 +1,224 @@
+# Command line entry point for the three ciphers.
+#
+#   python -m crypto_cli aes keygen
+#   python -m crypto_cli aes encrypt --key HEX -i plain.bin -o cipher.bin     # AES-GCM
+#   python -m crypto_cli aes decrypt --mode ecb --key HEX -i old.bin -o plain.bin
+#   python -m crypto_cli blowfish decrypt --key HEX -i cipher.bin -o plain.bin
+#   python -m crypto_cli rsa keygen --public pub.json --private priv.json
+#   python -m crypto_cli rsa encrypt --key pub.json --message 123456789
+#   python -m crypto_cli selftest
+#
+# Cipher modules are only imported by the subcommand that needs them.
+
+import argparse
+import json
+import os
+import sys
+
+
+def _open_input(path):
+    if path is None or path == "-":
+        return sys.stdin.buffer
+    return open(path, "rb")
+
+
+def _open_output(path):
+    if path is None or path == "-":
+        return sys.stdout.buffer
+    return open(path, "wb")
+
+
+def _stream_files(args, file_function, cipher):
+    src = _open_input(args.input)
+    dst = _open_output(args.output)
+    try:
+        file_function(cipher, src, dst)
+    finally:
+        if src is not sys.stdin.buffer:
+            src.close()
+        if dst is not sys.stdout.buffer:
+            dst.close()
+        else:
+            dst.flush()
+
+
+def _parse_key(text, min_len, max_len):
+    try:
+        key = bytes.fromhex(text)
+    except ValueError:
+        raise SystemExit("key must be a hex string")
+    if not min_len <= len(key) <= max_len:
+        raise SystemExit("key must be %d to %d bytes long" % (min_len, max_len))
+    return key
+
+
+# AES
+
+def cmd_aes(args):
+    if args.action == "keygen":
+        print(os.urandom(16).hex())
+        return 0
+
+    key = _parse_key(args.key, 16, 16)
+    if args.mode == "ecb":
+        import aes_encryption
+        import aes_stream
+
+        cipher = aes_encryption.AES_Encryption(key)
+        _stream_files(args, aes_stream.encrypt_file if args.action == "encrypt" else aes_stream.decrypt_file, cipher)
+        return 0
+
+    import aes_gcm
+
+    gcm = aes_gcm.AES_GCM(key)
+    try:
+        _stream_files(args, aes_gcm.encrypt_file if args.action == "encrypt" else aes_gcm.decrypt_file, gcm)
+    except aes_gcm.InvalidTag:
+        # Plaintext is written before the tag is checked, do not leave it behind
+        if args.output is not None and args.output != "-":
+            os.remove(args.output)
+        raise SystemExit("authentication failed, the input is corrupt or the key is wrong")
+    return 0
+
+
+# Blowfish
+
+def cmd_blowfish(args):
+    if args.action == "keygen":
+        print(os.urandom(16).hex())
+        return 0
+
+    import blowfish
+    import blowfish_stream
+
+    cipher = blowfish.Blowfish(_parse_key(args.key, 4, 56))
+    _stream_files(args, blowfish_stream.encrypt_file if args.action == "encrypt" else blowfish_stream.decrypt_file, cipher)
+    return 0
+
+
+# RSA, keys are stored as JSON objects with integer fields
+
+def _load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_json(path, obj):
+    if path is None:
+        print(json.dumps(obj))
+        return
+    with open(path, "w") as f:
+        json.dump(obj, f)
+
+
+def cmd_rsa(args):
+    import rsa_encryption
+
+    if args.action == "keygen":
+        (e, n), private = rsa_encryption.generate_keys()
+        _save_json(args.public, {"e": e, "n": n})
+        _save_json(args.private, private._asdict())
+        return 0
+
+    if args.key is None or args.message is None:
+        raise SystemExit("rsa %s needs --key and --message" % args.action)
+
+    key = _load_json(args.key)
+    if not 0 <= args.message < key["n"]:
+        raise SystemExit("message must be a non-negative integer smaller than n")
+    if args.action == "encrypt":
+        print(pow(args.message, key["e"], key["n"]))
+    elif "p" in key:
+        print(rsa_encryption.RSAPrivateKey(**key).decrypt(args.message))
+    else:
+        # Keys written before the CRT parameters were stored
+        print(pow(args.message, key["d"], key["n"]))
+    return 0
+
+
+# Self-test
+
+def check_rsa():
+    import rsa_encryption
+
+    (e, n), private = rsa_encryption.generate_keys()
+    message = 123456789
+    ciphertext = pow(message, e, n)
+    if private.decrypt(ciphertext) == message and pow(ciphertext, private.d, n) == message:
+        print("RSA round trip OK")
+        return True
+    print("RSA round trip failed")
+    return False
+
+
+def cmd_selftest(args):
+    import aes_bitslice
+    import aes_encryption
+    import aes_gcm
+    import aes_numpy
+    import blowfish
+    import blowfish_bcrypt
+    import blowfish_cache
+    import blowfish_keystream
+    import blowfish_numpy
+    import blowfish_stream
+    import import_budget
+
+    results = [aes_encryption.AES_Encryption.test(), aes_numpy.run_test(), aes_bitslice.run_test(), aes_gcm.run_test(),
+               blowfish.run_test(), blowfish_numpy.run_test(), blowfish_stream.run_test(), blowfish_keystream.run_test(),
+               blowfish_cache.run_test(), blowfish_bcrypt.run_test()]
+    if not args.quick:
+        import primality
+
+        results.append(primality.run_test())
+        results.append(check_rsa())
+    results.append(import_budget.run_test())
+
+    if all(results):
+        print("All self-tests passed")
+        return 0
+    print("Self-test FAILED")
+    return 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m crypto_cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, handler, help_text in (("aes", cmd_aes, "AES file encryption, GCM by default"),
+                                     ("blowfish", cmd_blowfish, "Blowfish-CBC file encryption")):
+        sub = commands.add_parser(name, help=help_text)
+        sub.add_argument("action", choices=("encrypt", "decrypt", "keygen"))
+        sub.add_argument("--key", help="key as a hex string")
+        sub.add_argument("-i", "--input", help="input file, stdin by default")
+        sub.add_argument("-o", "--output", help="output file, stdout by default")
+        if name == "aes":
+            sub.add_argument("--mode", choices=("gcm", "ecb"), default="gcm",
+                             help="gcm: authenticated, nonce + ciphertext + tag (default). "
+                                  "ecb: unauthenticated and leaks repeated blocks, for files "
+                                  "written by older versions only")
+        sub.set_defaults(handler=handler)
+
+    sub = commands.add_parser("rsa", help="RSA key generation and integer encryption")
+    sub.add_argument("action", choices=("encrypt", "decrypt", "keygen"))
+    sub.add_argument("--key", help="JSON key file for encrypt/decrypt")
+    sub.add_argument("--message", type=int, help="integer message or ciphertext")
+    sub.add_argument("--public", help="where keygen writes the public key, stdout by default")
+    sub.add_argument("--private", help="where keygen writes the private key, stdout by default")
+    sub.set_defaults(handler=cmd_rsa)
+
+    sub = commands.add_parser("selftest", help="run the known answer tests and the import time check")
+    sub.add_argument("--quick", action="store_true", help="skip RSA key generation")
+    sub.set_defaults(handler=cmd_selftest)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command in ("aes", "blowfish") and args.action != "keygen" and args.key is None:
+        raise SystemExit("%s %s needs --key" % (args.command, args.action))
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
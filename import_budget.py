@@ -0,0 +1,46 @@
+# Import time budget for the modules a worker imports at start-up. Runs on its own
+# (exit status 1 when over budget) and as part of crypto_cli selftest:
+#
+#   python -m import_budget
+
+import os
+import subprocess
+import sys
+
+IMPORT_MODULES = ("aes_encryption", "blowfish", "rsa_encryption")
+IMPORT_TIME_BUDGET = 0.02
+
+
+def measure(modules=IMPORT_MODULES):
+    # Fresh interpreter so nothing is cached in sys.modules. Bytecode writing is
+    # allowed and the first run is thrown away, so the measurement reflects a normal,
+    # warmed-up install
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        "import %s\n"
+        "print(time.perf_counter() - start)\n" % ", ".join(modules)
+    )
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    subprocess.run([sys.executable, "-c", code], cwd=here, env=env, check=True, capture_output=True)
+    result = subprocess.run([sys.executable, "-c", code], cwd=here, env=env, check=True,
+                            capture_output=True, text=True)
+    return float(result.stdout.strip())
+
+
+def run_test():
+    print("Running import time test")
+    elapsed = measure()
+    print("Import time: %.1f ms (budget %.0f ms)" % (elapsed * 1000, IMPORT_TIME_BUDGET * 1000))
+    if elapsed > IMPORT_TIME_BUDGET:
+        print("Test failed, import time over budget")
+        return False
+    print("Test OK")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_test() else 1)
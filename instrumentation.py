@@ -0,0 +1,71 @@
+# Opt-in counters and cumulative timers for the cipher hot paths.
+#
+#   import instrumentation
+#   instrumentation.enable()
+#   ... encrypt things ...
+#   print(instrumentation.stats())
+#
+# Instrumented code checks the module level `enabled` flag before doing anything else,
+# so while it is off the only cost is one attribute lookup per call.
+
+import threading
+import time
+
+enabled = False
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+_hooks = []
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def record(name, count=1, seconds=None):
+    # Add count to the counter called name and, if given, seconds to its timer.
+    # Hooks are called outside the lock with the same arguments
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + count
+        if seconds is not None:
+            _timers[name] = _timers.get(name, 0.0) + seconds
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(name, count, seconds)
+
+
+def stats():
+    # Snapshot of every counter and timer (in seconds) recorded since the last reset
+    with _lock:
+        return {"counters": dict(_counters), "timers": dict(_timers)}
+
+
+def add_hook(callback):
+    with _lock:
+        _hooks.append(callback)
+
+
+def remove_hook(callback):
+    with _lock:
+        _hooks.remove(callback)
+
+
+# Shorthand for call sites: start = instrumentation.now() ... record(name, n, elapsed(start))
+now = time.perf_counter
+
+
+def elapsed(start):
+    return time.perf_counter() - start
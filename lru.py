@@ -0,0 +1,50 @@
+# Thread-safe bounded LRU shared by the key schedule caches. Entries are keyed by a
+# digest the caller computes, hits and evictions are counted here and subclasses
+# count whatever else they need under the same lock.
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.evictions = 0
+
+    def _lookup(self, digest):
+        # The cached value or None, a hit moves the entry to the young end
+        with self._lock:
+            value = self._entries.get(digest)
+            if value is not None:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+        return value
+
+    def _insert(self, digest, value):
+        # Returns how many entries were evicted to make room
+        evicted = 0
+        with self._lock:
+            self._entries[digest] = value
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        return evicted
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size,
+                    "hits": self.hits, "evictions": self.evictions}
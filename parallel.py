@@ -0,0 +1,37 @@
+# Helpers to run block cipher work on a process pool without pickling the payload.
+# The buffer is copied once into a shared memory block, every worker attaches to it
+# by name and transforms its own slice in place.
+
+# multiprocessing is imported on first use, it is by far the most expensive import
+# in the project and most callers never touch a pool
+
+def attach_shared(name):
+    from multiprocessing import shared_memory
+
+    # Pool workers share the parent's resource tracker, so attaching here does not
+    # change who owns the block, run_shared unlinks it when the work is done
+    return shared_memory.SharedMemory(name=name)
+
+
+def run_shared(executor, data, worker, jobs):
+    # Run worker(shm_name, *job) on the executor for every job and return the
+    # shared buffer once all of them finished
+    from multiprocessing import shared_memory
+
+    size = len(data)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        shm.buf[:size] = data
+        futures = [executor.submit(worker, shm.name, *job) for job in jobs]
+        for future in futures:
+            future.result()
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def split_range(length, chunk_size, align):
+    # Split [0, length) into (start, end) pairs, every start aligned to the block size
+    chunk_size = max(align, chunk_size - chunk_size % align)
+    return [(start, min(start + chunk_size, length)) for start in range(0, length, chunk_size)]
@@ -0,0 +1,247 @@
+# Probabilistic primality tests for RSA key generation.
+#
+#   primality.is_prime(n)                        # Baillie-PSW
+#   primality.is_prime(n, method="miller_rabin") # random bases, rounds by bit size
+#
+# Baillie-PSW is a strong probable prime test to base 2 followed by a strong Lucas
+# probable prime test with Selfridge's parameters. No composite passing both is known,
+# and it costs about three full size exponentiations, where miller_rabin(n, 40) in
+# rsa_encryption costs forty.
+
+import math
+
+import instrumentation
+
+# Miller-Rabin rounds for random candidates of at least this many bits, the OpenSSL
+# BN_prime_checks_for_size table (error probability below 2^-80)
+MILLER_RABIN_ROUNDS = (
+    (3747, 3),
+    (1345, 4),
+    (476, 5),
+    (400, 6),
+    (347, 7),
+    (308, 8),
+    (55, 27),
+    (0, 34),
+)
+
+_SMALL_PRIMES = (3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97)
+
+
+def miller_rabin_rounds(bits):
+    for min_bits, rounds in MILLER_RABIN_ROUNDS:
+        if bits >= min_bits:
+            return rounds
+
+
+def _trial_division(n):
+    # True or False when a small prime settles it, None otherwise
+    if n < 2:
+        return False
+    if n % 2 == 0:
+        return n == 2
+    for p in _SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+    if n < _SMALL_PRIMES[-1] ** 2:
+        return True
+    return None
+
+
+def is_strong_probable_prime(n, base):
+    # Strong Fermat test of an odd n > 2 to the given base
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    x = pow(base, d, n)
+    if x == 1 or x == n - 1:
+        return True
+    for _ in range(s - 1):
+        x = x * x % n
+        if x == n - 1:
+            return True
+    return False
+
+
+def jacobi(a, n):
+    # Jacobi symbol (a/n) for odd n > 0
+    a %= n
+    result = 1
+    while a:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+
+def _selfridge_parameters(n):
+    # First D in 5, -7, 9, -11, ... with (D/n) = -1, P = 1, Q = (1 - D) / 4.
+    # None when some D shares a factor with n (so n is composite)
+    d = 5
+    while True:
+        j = jacobi(d, n)
+        if j == -1:
+            return d, 1, (1 - d) // 4
+        if j == 0 and abs(d) != n:
+            return None
+        d = -d - 2 if d > 0 else -d + 2
+
+
+def is_strong_lucas_probable_prime(n):
+    # Strong Lucas test of an odd n > 2 that is not a perfect square
+    parameters = _selfridge_parameters(n)
+    if parameters is None:
+        return False
+    D, P, Q = parameters
+
+    # n + 1 = d * 2^s
+    d = n + 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    # U_k, V_k and Q^k for k = d, walking the bits of d from the top (k starts at 1)
+    U = 1
+    V = P
+    Qk = Q % n
+    for bit in bin(d)[3:]:
+        # k -> 2k
+        U = U * V % n
+        V = (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if bit == "1":
+            # k -> k + 1, the halving is done modulo n (n is odd)
+            U, V = P * U + V, D * U + P * V
+            if U % 2:
+                U += n
+            if V % 2:
+                V += n
+            U = (U // 2) % n
+            V = (V // 2) % n
+            Qk = Qk * Q % n
+
+    if U == 0 or V == 0:
+        return True
+    for _ in range(s - 1):
+        V = (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if V == 0:
+            return True
+    return False
+
+
+def baillie_psw(n):
+    start = instrumentation.now() if instrumentation.enabled else None
+    result = _trial_division(n)
+    if result is None:
+        result = (is_strong_probable_prime(n, 2)
+                  and math.isqrt(n) ** 2 != n
+                  and is_strong_lucas_probable_prime(n))
+    if start is not None:
+        instrumentation.record("primality.baillie_psw", 1, instrumentation.elapsed(start))
+    return result
+
+
+def miller_rabin(n, rounds=None):
+    # Miller-Rabin with random bases, rounds defaults to the table for n's bit size
+    import secrets
+
+    start = instrumentation.now() if instrumentation.enabled else None
+    result = _trial_division(n)
+    done = 0
+    if result is None:
+        if rounds is None:
+            rounds = miller_rabin_rounds(n.bit_length())
+        result = True
+        for _ in range(rounds):
+            done += 1
+            if not is_strong_probable_prime(n, secrets.randbelow(n - 3) + 2):
+                result = False
+                break
+    if start is not None:
+        instrumentation.record("primality.miller_rabin", 1, instrumentation.elapsed(start))
+        # Same counter key generation recorded before it moved to this module
+        if done:
+            instrumentation.record("rsa.miller_rabin.rounds", done)
+    return result
+
+
+def is_prime(n, method="bpsw"):
+    if method == "bpsw":
+        return baillie_psw(n)
+    if method == "miller_rabin":
+        return miller_rabin(n)
+    raise ValueError("unknown primality test %r" % method)
+
+
+# Correctness corpus
+
+CARMICHAEL_NUMBERS = (
+    561, 1105, 1729, 2465, 2821, 6601, 8911, 10585, 15841, 29341, 41041, 46657, 52633,
+    62745, 63973, 75361, 101101, 115921, 126217, 162401, 172081, 188461, 252601, 278545,
+    294409, 314821, 334153, 340561, 399001, 410041, 449065, 488881, 512461,
+)
+
+# Composites that pass the strong test to base 2
+STRONG_PSEUDOPRIMES_BASE_2 = (
+    2047, 3277, 4033, 4681, 8321, 15841, 29341, 42799, 49141, 52633, 65281, 74665, 80581,
+    85489, 88357, 90751,
+)
+
+# Composites that pass the strong Lucas test with Selfridge's parameters
+STRONG_LUCAS_PSEUDOPRIMES = (
+    5459, 5777, 10877, 16109, 18971, 22499, 24569, 25199, 40309, 58519, 75077, 97439,
+    100127, 113573, 115639, 130139,
+)
+
+# Strong pseudoprimes to every prime base from 2 up to 7 / 31 / 37 respectively
+MULTI_BASE_PSEUDOPRIMES = (3215031751, 3825123056546413051, 318665857834031151167461)
+
+KNOWN_PRIMES = (2, 3, 5, 97, 101, 7919, 2 ** 31 - 1, 2 ** 61 - 1, 2 ** 89 - 1, 2 ** 127 - 1, 2 ** 521 - 1)
+
+
+def run_test():
+    print("Running primality unit test")
+    composites = CARMICHAEL_NUMBERS + STRONG_PSEUDOPRIMES_BASE_2 + STRONG_LUCAS_PSEUDOPRIMES + MULTI_BASE_PSEUDOPRIMES
+
+    # The corpus has to be what it claims, or the checks below prove nothing
+    if not all(is_strong_probable_prime(n, 2) for n in STRONG_PSEUDOPRIMES_BASE_2 + MULTI_BASE_PSEUDOPRIMES):
+        print("Test failed, corpus entry is not a base 2 strong pseudoprime")
+        return False
+    if not all(is_strong_lucas_probable_prime(n) for n in STRONG_LUCAS_PSEUDOPRIMES):
+        print("Test failed, corpus entry is not a strong Lucas pseudoprime")
+        return False
+
+    for method in ("bpsw", "miller_rabin"):
+        if any(is_prime(n, method) for n in composites):
+            print("Test failed, %s accepted a pseudoprime" % method)
+            return False
+        if not all(is_prime(n, method) for n in KNOWN_PRIMES):
+            print("Test failed, %s rejected a prime" % method)
+            return False
+
+    # Exhaustive against a sieve for small n
+    limit = 20000
+    sieve = bytearray([1]) * limit
+    sieve[0:2] = b"\0\0"
+    for i in range(2, int(limit ** 0.5) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, limit, i)))
+    if any(baillie_psw(n) != bool(sieve[n]) for n in range(limit)):
+        print("Test failed against the sieve")
+        return False
+    print("Test OK")
+    return True
+
+
+if __name__ == "__main__":
+    run_test()
@@ -1,19 +1,48 @@
-import secrets
+from collections import namedtuple
+
+import instrumentation
+import primality
 
 PRIME_BIT_SIZE = 1024
+# generate_prime sieves windows of this many odd candidates against the odd primes
+# below SIEVE_PRIME_LIMIT before any of them reaches Miller-Rabin
+SIEVE_PRIME_LIMIT = 1 << 16
+SIEVE_WINDOW = 4096
+# Test that confirms sieve survivors, "bpsw" or "miller_rabin" (see primality.is_prime)
+PRIMALITY_TEST = "bpsw"
 
 
+# secrets is imported where it is used, it pulls in a large part of the standard
+# library and would dominate the import time of this module
 def generate_prime_candidate(bits):
+    import secrets
+
+    start = instrumentation.now() if instrumentation.enabled else None
+    tried = 0
     flag = False
     while flag != True:
         p = secrets.randbits(bits)
         # Add 1 as the last bit to guarantee an odd number
         p = p|1
         flag = is_low_level_prime(p)
+        tried += 1
+
+    if start is not None:
+        instrumentation.record("rsa.prime_candidates", tried, instrumentation.elapsed(start))
     return p
     
 
 def miller_rabin(n, k = 40):
+    if not instrumentation.enabled:
+        return _miller_rabin(n, k)
+
+    start = instrumentation.now()
+    result = _miller_rabin(n, k)
+    instrumentation.record("rsa.miller_rabin", 1, instrumentation.elapsed(start))
+    return result
+
+def _miller_rabin(n, k):
+    import secrets
 
     # Discard clearly non prime numbers, or True un case of 2
     if n <= 1: return False
@@ -69,16 +98,86 @@ def is_low_level_prime(n):
             return False
     return True
 
+_sieve_primes = None
+
+def small_primes():
+    # Odd primes below SIEVE_PRIME_LIMIT, computed once with a sieve of Eratosthenes
+    global _sieve_primes
+    if _sieve_primes is None:
+        limit = SIEVE_PRIME_LIMIT
+        flags = bytearray([1]) * limit
+        flags[0:2] = b"\0\0"
+        for i in range(2, int(limit ** 0.5) + 1):
+            if flags[i]:
+                flags[i * i::i] = bytes(len(range(i * i, limit, i)))
+        _sieve_primes = [i for i in range(3, limit) if flags[i]]
+    return _sieve_primes
+
+def generate_prime(bits):
+    # Random prime of exactly `bits` bits with the top two bits set, so the product of
+    # two of them has exactly 2 * bits bits. One random odd starting point, then the
+    # odd numbers after it are sieved window by window. The residues of the window start
+    # modulo every small prime are updated incrementally instead of recomputed.
+    # Survivors are confirmed with PRIMALITY_TEST. rsa.prime_candidates times only the
+    # candidate generation and sieving, the tests are timed by primality itself
+    import bisect
+    import secrets
+
+    if bits < 2:
+        raise ValueError("a prime with the top two bits set needs at least 2 bits")
+    timed = instrumentation.enabled
+    sieving = 0.0
+    start = instrumentation.now() if timed else None
+    # Only primes below the smallest candidate, for small sizes a candidate could be one
+    # of the sieve primes and would be sieved out as its own multiple
+    primes = small_primes()
+    primes = primes[:bisect.bisect_left(primes, 3 << (bits - 2))]
+    half = [(p + 1) >> 1 for p in primes]  # inverse of 2 modulo p
+    tested = 0
+    if timed:
+        sieving += instrumentation.elapsed(start)
+
+    while True:
+        if timed:
+            start = instrumentation.now()
+        base = secrets.randbits(bits) | (3 << (bits - 2)) | 1
+        residues = [base % p for p in primes]
+
+        while base.bit_length() == bits:
+            # sieve[i] stands for base + 2i, clear every i where p divides it
+            sieve = bytearray([1]) * SIEVE_WINDOW
+            for p, r, h in zip(primes, residues, half):
+                i = (p - r) * h % p
+                if i < SIEVE_WINDOW:
+                    sieve[i::p] = bytes((SIEVE_WINDOW - 1 - i) // p + 1)
+            if timed:
+                sieving += instrumentation.elapsed(start)
+
+            for i in range(SIEVE_WINDOW):
+                if not sieve[i]:
+                    continue
+                candidate = base + 2 * i
+                if candidate.bit_length() != bits:
+                    break
+                tested += 1
+                if primality.is_prime(candidate, PRIMALITY_TEST):
+                    if timed:
+                        instrumentation.record("rsa.prime_candidates", tested, sieving)
+                    return candidate
+
+            if timed:
+                start = instrumentation.now()
+            step = 2 * SIEVE_WINDOW
+            base += step
+            residues = [(r + step) % p for p, r in zip(primes, residues)]
+
 def generate_p_and_q():
-    # Generate 1st prime number p
-    p = generate_prime_candidate(PRIME_BIT_SIZE)
-    while not miller_rabin(p):
-        p = generate_prime_candidate(PRIME_BIT_SIZE)
+    p = generate_prime(PRIME_BIT_SIZE)
 
     # Generate 2nd prime number q, and guarantee it's different than p
-    q = generate_prime_candidate(PRIME_BIT_SIZE)
-    while not miller_rabin(q) or q == p:
-        q = generate_prime_candidate(PRIME_BIT_SIZE)
+    q = generate_prime(PRIME_BIT_SIZE)
+    while q == p:
+        q = generate_prime(PRIME_BIT_SIZE)
 
     return p, q
 
@@ -97,34 +196,65 @@ def extended_gcd(a, b):
 
     return a, x0, y0
 
-def generate_keys():
-    e = 65537
+# Private key with the CRT parameters. Code written against the old (d, n) tuples
+# keeps working as long as it indexes them: private[0] is still d and private[1] still
+# n. Unpacking does not, `d, n = private` raises because the tuple has seven fields
+class RSAPrivateKey(namedtuple("RSAPrivateKey", "d n p q dP dQ qInv")):
+    __slots__ = ()
 
-    while True:
-        p, q = generate_p_and_q()
+    @classmethod
+    def from_primes(cls, e, p, q):
         phi = (p-1) * (q-1)
         g, x, y = extended_gcd(e, phi)
-        if g == 1:
-            break
+        if g != 1:
+            raise ValueError("e is not invertible modulo phi(n)")
+        d = x % phi
+        # q^-1 mod p, p and q are distinct primes so the inverse exists
+        q_inv = extended_gcd(q, p)[1] % p
+        return cls(d, p * q, p, q, d % (p-1), d % (q-1), q_inv)
+
+    # m^d mod n as two half size exponentiations recombined with Garner's formula
+    def decrypt(self, ciphertext):
+        start = instrumentation.now() if instrumentation.enabled else None
+        if not 0 <= ciphertext < self.n:
+            raise ValueError("ciphertext must be a non-negative integer smaller than n")
+        m1 = pow(ciphertext, self.dP, self.p)
+        m2 = pow(ciphertext, self.dQ, self.q)
+        h = self.qInv * (m1 - m2) % self.p
+        message = m2 + h * self.q
+        if start is not None:
+            instrumentation.record("rsa.private_op", 1, instrumentation.elapsed(start))
+        return message
+
+    def sign(self, message):
+        return self.decrypt(message)
 
-    n = p * q
-    d = x % phi
 
-    return (e, n), (d, n)
+def generate_keys():
+    e = 65537
 
+    while True:
+        p, q = generate_p_and_q()
+        try:
+            private = RSAPrivateKey.from_primes(e, p, q)
+        except ValueError:
+            # e shares a factor with phi(n), try other primes
+            continue
+        return (e, private.n), private
 
 
-# Start o RSA public and private key generation
-public, private = generate_keys()
-e = public[0]
-n = public[1]
-d = private[0]
 
-message = 123456789
+if __name__ == "__main__":
+    # Start o RSA public and private key generation
+    public, private = generate_keys()
+    e = public[0]
+    n = public[1]
+    d = private[0]
 
-ciphertext = pow(message, e, n)
-print("CIPHER: ", ciphertext)
+    message = 123456789
 
-decipher = pow(ciphertext, d , n)
-print("\n\nDECIPHER: ", decipher)
+    ciphertext = pow(message, e, n)
+    print("CIPHER: ", ciphertext)
 
+    decipher = private.decrypt(ciphertext)
+    print("\n\nDECIPHER: ", decipher)
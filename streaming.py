@@ -0,0 +1,69 @@
+# Pieces shared by the streaming cipher modules.
+#
+# BlockEncryptor / BlockDecryptor carry partial blocks between update() calls for a
+# padded block mode and only handle the padding in finalize(), so memory use is bounded
+# by the chunk size and not the payload. transform(data) is the raw cipher over whole
+# blocks and is called with every run of complete blocks in order, possibly empty.
+#
+# pump() drives any object with update(chunk) -> bytes and finalize() -> bytes from
+# src to dst, both binary file-like objects.
+
+
+class BlockEncryptor:
+    def __init__(self, block_size, transform, pad):
+        self._block_size = block_size
+        self._transform = transform
+        self._pad = pad
+        self._pending = b""
+
+    def update(self, chunk):
+        data = self._pending + bytes(chunk)
+        full = len(data) - len(data) % self._block_size
+        self._pending = data[full:]
+        return self._transform(data[:full])
+
+    def finalize(self):
+        # Always emits the padding block, even for an empty or block aligned stream
+        data = self._pad(self._pending)
+        self._pending = b""
+        return self._transform(data)
+
+
+class BlockDecryptor:
+    def __init__(self, block_size, transform, unpad):
+        self._block_size = block_size
+        self._transform = transform
+        self._unpad = unpad
+        self._pending = b""
+
+    def update(self, chunk):
+        data = self._pending + bytes(chunk)
+        full = len(data) - len(data) % self._block_size
+        # The last full block may hold the padding, keep it until finalize
+        if full == len(data):
+            full -= self._block_size
+        full = max(full, 0)
+        self._pending = data[full:]
+        return self._transform(data[:full])
+
+    def finalize(self):
+        if len(self._pending) != self._block_size:
+            raise ValueError("ciphertext length is not a multiple of the block size")
+        data = self._transform(self._pending)
+        self._pending = b""
+        return self._unpad(data)
+
+
+def pump(stream, src, dst, chunk_size):
+    # Returns the number of bytes written to dst
+    written = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        out = stream.update(chunk)
+        dst.write(out)
+        written += len(out)
+    out = stream.finalize()
+    dst.write(out)
+    return written + len(out)